@@ -18,6 +18,7 @@
 """Stopwatch Activity"""
 """Actividad Cronometro"""
 import logging
+from gettext import gettext as _
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -29,6 +30,7 @@ from gi.repository import GObject
 from gi.repository import TelepathyGLib
 
 from sugar3.graphics.toolbarbox import ToolbarBox
+from sugar3.graphics.toolcombobox import ToolComboBox
 from sugar3.activity.activity import Activity
 from sugar3.activity.widgets \
     import StopButton, ShareButton, TitleEntry, ActivityButton
@@ -77,6 +79,29 @@ class StopWatchActivity(Activity):
         toolbar_box.toolbar.insert(share_button, -1)
         share_button.show()
 
+        self._precision_combo = ToolComboBox(label_text=_('Precision:'))
+        for (precision, label) in (
+                (stopwatch.TimeFormatter.HUNDREDTHS, _('Hundredths')),
+                (stopwatch.TimeFormatter.TENTHS, _('Tenths')),
+                (stopwatch.TimeFormatter.SECONDS, _('Seconds')),
+                (stopwatch.TimeFormatter.MINUTES, _('Minutes'))):
+            self._precision_combo.combo.append_item(precision, label)
+        self._precision_combo.combo.set_active(0)
+        self._precision_combo.combo.connect('changed', self._precision_cb)
+        toolbar_box.toolbar.insert(self._precision_combo, -1)
+        self._precision_combo.show()
+
+        self._count_spin = Gtk.SpinButton()
+        self._count_spin.set_range(1, stopwatch.GUIView.MAX_WATCHES)
+        self._count_spin.set_increments(1, stopwatch.GUIView.ROWS)
+        self._count_spin.set_value(stopwatch.GUIView.NUM_WATCHES)
+        self._count_spin.set_tooltip_text(_('Number of stopwatches'))
+        self._count_spin.connect('value-changed', self._count_cb)
+        count_item = Gtk.ToolItem()
+        count_item.add(self._count_spin)
+        toolbar_box.toolbar.insert(count_item, -1)
+        count_item.show_all()
+
         separator = Gtk.SeparatorToolItem()
         separator.props.draw = False
         separator.set_expand(True)
@@ -111,8 +136,6 @@ class StopWatchActivity(Activity):
         self.connect("visibility-notify-event", self._visible_cb)
         self.connect("notify::active", self._active_cb)
 
-        self.connect('key-press-event', self._keypress_cb)
-
     def _shared_cb(self, activity):
         self._logger.debug('My activity was shared')
         self.initiating = True
@@ -180,6 +203,8 @@ class StopWatchActivity(Activity):
             q = pickle.loads(s)
         f.close()
         self.gui.set_all(q)
+        self._precision_combo.combo.set_active(self.gui.get_precision())
+        self._count_spin.set_value(self.gui.get_num_watches())
 
     def write_file(self, file_path):
         self.metadata['mime_type'] = 'application/x-stopwatch-activity'
@@ -189,6 +214,12 @@ class StopWatchActivity(Activity):
         f.write(s)
         f.close()
 
+    def _precision_cb(self, combo):
+        self.gui.set_precision(combo.get_value())
+
+    def _count_cb(self, spin):
+        self.gui.set_num_watches(spin.get_value_as_int())
+
     def _active_cb(self, widget, event):
         self._logger.debug("_active_cb")
         if self.props.active:
@@ -202,11 +233,3 @@ class StopWatchActivity(Activity):
             self.gui.pause()
         else:
             self.gui.resume()
-
-    def _keypress_cb(self, widget, event):
-        if event.keyval in (Gdk.KEY_Up, Gdk.KEY_ISO_Left_Tab):
-            self.gui.select_up()
-            return True
-        elif event.keyval in (Gdk.KEY_Down, Gdk.KEY_Tab):
-            self.gui.select_down()
-            return True
@@ -19,11 +19,12 @@ along with DObject.  If not, see <http://www.gnu.org/licenses/>.
 import dbus
 import dbus.service
 from dbus.gi_service import ExportedGObject
-import time
+from gi.repository import GObject
 import logging
 import threading
-import _thread
 import random
+import bisect
+import zlib
 from dobject_helpers import *
 
 """
@@ -57,6 +58,7 @@ class TubeBox:
         self.tube = None
         self.is_initiator = None
         self._listeners = []
+        self._unordered_mux = None
     
     def register_listener(self, L):
         """This method is used by the DObject handlers to add a callback
@@ -65,6 +67,13 @@ class TubeBox:
         if self.tube is not None:
             L(self.tube, self.is_initiator)
     
+    def get_unordered_mux(self):
+        """Returns the UnorderedMux shared by the UnorderedHandlers in this
+        TubeBox, creating it when the first handler asks"""
+        if self._unordered_mux is None:
+            self._unordered_mux = UnorderedMux(self)
+        return self._unordered_mux
+    
     def insert_tube(self, tube, is_initiator=False):
         """This method is used by the sharing code to provide the tube, once it
         is ready, along with a boolean indicating whether or not this computer
@@ -78,12 +87,25 @@ class TubeBox:
 class TimeHandler(ExportedGObject):
     """A TimeHandler provides a universal clock for a sharing instance.  It is a
     sort of cheap, decentralized synchronization system.  The TimeHandler 
-    determines the offset between local time and group time by sending a
-    broadcast and accepting the first response, and assuming that both transfer
-    displays were equal.  The initiator's offset is 0.0, but once another group
-    member has synchronized, the initiator can leave and new members will still
-    be synchronized correctly.  Errors at each synchronization are typically
-    between 0.1s and 2s.
+    determines the offset between local time and group time by broadcasting
+    requests, NTP-style, and collecting the responses of every synchronized
+    member.  Each response gives an estimate of the offset, assuming that both
+    transfer delays were equal.  Its error is at most half of the round trip
+    delay plus the responder's own error, which the responder reports along
+    with its time.  The requests are repeated every RESYNC_INTERVAL seconds,
+    and from each such burst the estimate with the smallest round trip is kept.
+    Every synchronized member answers every request, so the interval doubles
+    after each burst whose best estimate is within ERROR_GOAL, up to
+    MAX_RESYNC_INTERVAL, and returns to RESYNC_INTERVAL otherwise.  Cheap
+    clocks drift by tens of parts per million, so the offset is not constant: a
+    least-squares line through the kept estimates of the last DRIFT_WINDOW
+    seconds, weighted by their errors, gives both the offset and its rate of
+    change (the skew), and time() extrapolates along that line.  Until the
+    estimates span MIN_SKEW_SPAN seconds, the skew is taken to be zero.
+    Requests are scheduled with GLib timeouts and responses handled as they
+    arrive, all on the main loop.  The initiator's offset is 0.0, but once
+    another group member has synchronized, the initiator can leave and new
+    members will still be synchronized correctly.
     
     TimeHandler is not perfectly resilient to disappearances.  If the group
     splits, and one of the daughter groups does not contain any members that
@@ -93,9 +115,24 @@ class TimeHandler(ExportedGObject):
     """
     IFACE = "org.dobject.TimeHandler"
     BASEPATH = "/org/dobject/TimeHandler/"
+    SAMPLES_PER_SYNC = 4 # requests broadcast at each synchronization
+    SAMPLE_SPACING = 0.5 # seconds between those requests
+    RESYNC_INTERVAL = 60.0 # seconds between synchronizations
+    MAX_RESYNC_INTERVAL = 960.0 # seconds between them once the error is small
+    ERROR_GOAL = 0.05 # seconds of error below which resyncs back off
+    DRIFT_WINDOW = 3600.0 # seconds of estimates used to fit the skew
+    MIN_SKEW_SPAN = 600.0 # seconds the estimates must span to fit the skew
+    MAX_SKEW = 5e-5 # drift assumed for cheap clocks while it is not fitted
+    MIN_ERROR = 1e-4 # seconds; a floor on the errors used to weight estimates
 
-    def __init__(self, name, tube_box, offset=0.0):
+    def __init__(self, name, tube_box, offset=0.0, clock=None):
+        """All local times are read from clock, which must provide time() and
+        time_ns() like a MonotonicClock.  By default a new MonotonicClock is
+        used, so that group time never steps with the system clock."""
         self.PATH = TimeHandler.BASEPATH + name
+        if clock is None:
+            clock = MonotonicClock()
+        self._clock = clock
         ExportedGObject.__init__(self)
         self._logger = logging.getLogger(self.PATH)
         self._tube_box = tube_box
@@ -104,6 +141,14 @@ class TimeHandler(ExportedGObject):
         
         self.offset = offset
         self._know_offset = False
+        self._authoritative = False # True if the offset is given, not measured
+        self._error = float('inf') # bound on the offset's error at self._ref
+        self._skew_error = 0.0 # rate at which the bound grows away from _ref
+        self._skew = 0.0 # rate of change of the offset
+        self._ref = 0.0 # local time at which the offset is self.offset
+        self._burst = None # best (error, offset, local time) of the current burst
+        self._points = [] # best estimates of the previous bursts
+        self._interval = TimeHandler.RESYNC_INTERVAL # until the next burst
         self._offset_lock = threading.Lock()
         
         self._tube_box.register_listener(self.get_tube)
@@ -115,29 +160,102 @@ class TimeHandler(ExportedGObject):
         self.tube = tube
         self.add_to_connection(self.tube, self.PATH)
         self.is_initiator = is_initiator
-        self._know_offset = is_initiator
+        if is_initiator:
+            self._set_authoritative()
         self.tube.add_signal_receiver(self.tell_time, signal_name='What_time_is_it', dbus_interface=TimeHandler.IFACE, sender_keyword='sender', path=self.PATH)
 
-        if not self._know_offset:
-            self.ask_time()
+        if not self._authoritative:
+            self._sync()
 
     def time(self):
         """Get the group time"""
-        return time.time() + self.offset
+        t = self._clock.time()
+        return t + self._offset_at(t)
+    
+    def time_ns(self):
+        """Get the group time in integer nanoseconds"""
+        t = self._clock.time_ns()
+        return t + int(round(self._offset_at(t / 1e9) * 1e9))
+    
+    def local_time(self):
+        """Get the local time from the same clock that time() uses"""
+        return self._clock.time()
+    
+    def _offset_at(self, t):
+        self._offset_lock.acquire()
+        offset = self.offset + self._skew*(t - self._ref)
+        self._offset_lock.release()
+        return offset
         
     def get_offset(self):
         """Get the difference between local time and group time"""
-        self._logger.debug("get_offset " + str(self.offset))
-        return self.offset
+        return self._offset_at(self._clock.time())
+    
+    def get_skew(self):
+        """Get the estimated drift of group time relative to local time, in
+        seconds per second"""
+        return self._skew
+    
+    def get_error(self):
+        """Get an estimate of the bound on the error of the offset, in seconds.
+        It includes the errors of the estimates and of the members that
+        answered, how far the estimates stray from the fitted line, and how far
+        that line is being extrapolated.  This is infinite before the first
+        synchronization, and zero if the offset was set rather than
+        measured."""
+        return self._error_at(self._clock.time())
+    
+    def _error_at(self, t):
+        self._offset_lock.acquire()
+        error = self._error + self._skew_error*abs(t - self._ref)
+        self._offset_lock.release()
+        return error
     
     def set_offset(self, offset):
-        """Set the difference between local time and group time, and assert that
-        this is correct"""
+        """Set the difference between local time and group time, e.g. as
+        restored from the journal.  This is only a starting estimate, of unknown
+        error: synchronization continues, and the first measurement replaces
+        it.  Once the offset has been measured, it is kept instead.  The
+        initiator's offset is always accepted, since it defines group time."""
         self._logger.debug("set_offset " + str(offset))
         self._offset_lock.acquire()
-        self.offset = offset
+        if self._authoritative or not self._know_offset:
+            self.offset = offset
+            self._skew = 0.0
+            self._know_offset = True
+        self._offset_lock.release()
+    
+    def _set_authoritative(self):
+        self._offset_lock.acquire()
         self._know_offset = True
+        self._authoritative = True
+        self._error = 0.0
+        self._skew_error = 0.0
+        self._offset_lock.release()
+    
+    def _sync(self):
+        """Broadcast a burst of time requests, and schedule the next burst"""
+        if self._authoritative:
+            return
+        self._offset_lock.acquire()
+        if self._burst is not None:
+            if self._burst[0] < TimeHandler.ERROR_GOAL:
+                self._interval = min(2*self._interval, TimeHandler.MAX_RESYNC_INTERVAL)
+            else:
+                self._interval = TimeHandler.RESYNC_INTERVAL
+            self._points.append(self._burst)
+            self._burst = None
         self._offset_lock.release()
+        for i in range(TimeHandler.SAMPLES_PER_SYNC):
+            self._start_timer(i * TimeHandler.SAMPLE_SPACING, self.ask_time)
+        self._start_timer(self._interval, self._sync)
+    
+    def _start_timer(self, delay, f):
+        GObject.timeout_add(int(delay * 1000), self._timer_cb, f)
+    
+    def _timer_cb(self, f):
+        f()
+        return False
 
     @dbus.service.signal(dbus_interface=IFACE, signature='d')
     def What_time_is_it(self, asktime):
@@ -145,11 +263,11 @@ class TimeHandler(ExportedGObject):
         
     def ask_time(self):
         self._logger.debug("ask_time")
-        self.What_time_is_it(time.time())
+        self.What_time_is_it(self._clock.time())
     
     def tell_time(self, asktime, sender=None):
         self._logger.debug("tell_time")
-        start_time = time.time()
+        start_time = self._clock.time()
         try:
             my_name = self.tube.get_unique_name()
             if sender == my_name:
@@ -157,26 +275,81 @@ class TimeHandler(ExportedGObject):
             if self._know_offset:
                 self._logger.debug("telling offset")
                 remote = self.tube.get_object(sender, self.PATH)
-                start_time += self.offset
-                remote.receive_time(asktime, start_time, time.time() + self.offset, reply_handler=PassFunction, error_handler=PassFunction)
+                error = self._error_at(start_time)
+                start_time += self._offset_at(start_time)
+                finish_time = self.time()
+                def error_cb(e):
+                    # The asker predates receive_time_bounded
+                    remote.receive_time(asktime, start_time, finish_time, reply_handler=PassFunction, error_handler=PassFunction)
+                remote.receive_time_bounded(asktime, start_time, finish_time, error, reply_handler=PassFunction, error_handler=error_cb)
         finally:
             return
     
     @dbus.service.method(dbus_interface=IFACE, in_signature='ddd', out_signature='')
     def receive_time(self, asktime, start_time, finish_time):
+        """Accepts a response from a member that does not report its error,
+        which is then taken to be zero"""
+        self.receive_time_bounded(asktime, start_time, finish_time, 0.0)
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature='dddd', out_signature='')
+    def receive_time_bounded(self, asktime, start_time, finish_time, error):
         self._logger.debug("receive_time")
-        rtime = time.time()
-        _thread.start_new_thread(self._handle_incoming_time, (asktime, start_time, finish_time, rtime))
+        rtime = self._clock.time()
+        self._handle_incoming_time(asktime, start_time, finish_time, rtime, error)
     
-    def _handle_incoming_time(self, ask, start, finish, receive):
+    def _handle_incoming_time(self, ask, start, finish, receive, remote_error=0.0):
+        delay = (receive - ask) - (finish - start)
+        offset = ((start + finish)/2) - ((ask + receive)/2)
+        sample = (delay/2 + remote_error, offset, (ask + receive)/2)
         self._offset_lock.acquire()
-        if not self._know_offset:
-            self.offset = ((start + finish)/2) - ((ask + receive)/2)
+        if not self._authoritative:
+            if (self._burst is None) or (sample < self._burst):
+                self._burst = sample
+            cutoff = receive - TimeHandler.DRIFT_WINDOW
+            self._points = [p for p in self._points if p[2] >= cutoff]
+            self._fit(self._points + [self._burst])
             self._know_offset = True
         self._offset_lock.release()
+    
+    def _fit(self, points):
+        """Fit offset = self.offset + self._skew*(t - self._ref) to the
+        (error, offset, t) points by least squares, weighting each point by
+        1/error**2.  Over a short span, the noise in the offsets swamps any
+        drift, and a fitted skew would only amplify it, so until the points
+        span MIN_SKEW_SPAN seconds the skew is 0 and the offset is that of the
+        point whose error, grown at MAX_SKEW since it was measured, is
+        smallest.
+        
+        Also sets the error bound at self._ref, and the rate at which it grows
+        away from self._ref.  For a fitted line, the bound is the combined
+        error of the points plus the weighted RMS residual, and it grows as
+        that bound divided by the weighted RMS spread of the points' times."""
+        finite = [p for p in points if p[0] < float('inf')]
+        times = [p[2] for p in finite]
+        if len(finite) < 2 or max(times) - min(times) < TimeHandler.MIN_SKEW_SPAN:
+            latest = max(p[2] for p in points)
+            best = min(points, key=lambda p: p[0] + TimeHandler.MAX_SKEW*(latest - p[2]))
+            self._skew = 0.0
+            self._ref = best[2]
+            self.offset = best[1]
+            self._error = best[0]
+            self._skew_error = TimeHandler.MAX_SKEW
+        else:
+            weights = [1/max(p[0], TimeHandler.MIN_ERROR)**2 for p in finite]
+            W = sum(weights)
+            ref = sum(w*p[2] for (w, p) in zip(weights, finite))/W
+            mean = sum(w*p[1] for (w, p) in zip(weights, finite))/W
+            var = sum(w*(p[2] - ref)**2 for (w, p) in zip(weights, finite))
+            self._skew = sum(w*(p[2] - ref)*(p[1] - mean) for (w, p) in zip(weights, finite))/var
+            self._ref = ref
+            self.offset = mean
+            residual = sum(w*(p[1] - mean - self._skew*(p[2] - ref))**2 for (w, p) in zip(weights, finite))/W
+            self._error = (1/W)**0.5 + residual**0.5
+            self._skew_error = self._error/(var/W)**0.5
+        self._logger.debug("_fit offset %s skew %s", self.offset, self._skew)
 
 
-class UnorderedHandler(ExportedGObject):
+class UnorderedHandler:
     """ The most basic DObject is the Unordered Object (UO).  A UO has the
     property that any changes to its state can be encapsulated as messages, and
     these messages have no intrinsic ordering.  Different instances of the same
@@ -206,37 +379,67 @@ class UnorderedHandler(ExportedGObject):
     
     add_history(state):
     This method accepts and processes the state object returned by get_history()
+    
+    A UO whose history can grow large may also implement get_digest() and
+    get_history_since(digest).  Before telling its history to another
+    participant, the handler then asks for that participant's digest, and sends
+    only what get_history_since() says is missing.
+    
+    A UO may also implement merge_messages(a, b), which returns a single
+    message equivalent to receiving message a and then message b.  Handlers of
+    such UOs can be given an outbox, which holds outgoing messages for a short
+    delay and merges them, so that a burst of local changes costs one signal.
+    
+    A UO whose messages can be packed into byte arrays implements
+    is_packable(), returning True, and accepts packed=True in get_history() and
+    get_history_since().  Its messages may then be dbus.ByteArrays, which the
+    handler sends only to participants that advertise the 'packed' capability.
+    
+    Handlers are not exported individually.  All the handlers in a TubeBox share
+    one UnorderedMux, which carries their traffic on the bus.
     """
     IFACE = "org.dobject.Unordered"
     BASEPATH = "/org/dobject/Unordered/"
+    RESPONDERS = 2 # number of participants that tell their history to each newcomer
+    RESPONSE_TIMEOUT = 5.0 # seconds before the other participants step in
+    COMPRESS_THRESHOLD = 4096 # bytes of packed history above which it is compressed
 
-    def __init__(self, name, tube_box):
+    def __init__(self, name, tube_box, outbox_delay=None, outbox_size=32):
         """To construct a UO, the program must provide a name and a TubeBox.
         The name is used to identify the UO; all UO with the same name on the
         same Tube should be considered views into the same abstract distributed
-        object."""
+        object.
+        
+        If outbox_delay is not None, messages from a UO that implements
+        merge_messages are held for up to outbox_delay seconds, or until
+        outbox_size messages have been merged, before they are broadcast.  The
+        local UO's state is unaffected; only the broadcast is delayed.  The
+        delay is a GLib timeout, so the broadcast happens on the main loop."""
         self._myname = name
         self.PATH = UnorderedHandler.BASEPATH + name
-        ExportedGObject.__init__(self)
         self._logger = logging.getLogger(self.PATH)
         self._tube_box = tube_box
         self.tube = None
+        self._mux = tube_box.get_unordered_mux()
+        self._rel_path = "/" + name # relative to the UnorderedMux
+        
+        self._outbox_delay = outbox_delay
+        self._outbox_size = outbox_size
+        self._outbox = None  # the merged pending message, if any
+        self._outbox_count = 0
+        self._outbox_source = None
+        self._outbox_lock = threading.Lock()
+        
+        self._fallbacks = {} # newcomer -> pending _fallback timeout
+        self._awaiting_history = False
+        self._unsettled = set() # peers that asked for a history and await it
         
         self.object = None
-        self._tube_box.register_listener(self.set_tube)
+        self._mux.add(self)
 
     def set_tube(self, tube, is_initiator):
-        """Callback for the TubeBox"""
+        """Callback for the UnorderedMux"""
         self.tube = tube
-        self.add_to_connection(self.tube, self.PATH)
-                        
-        self.tube.add_signal_receiver(self.receive_message, signal_name='send', dbus_interface=UnorderedHandler.IFACE, sender_keyword='sender', path=self.PATH)
-        self.tube.add_signal_receiver(self.tell_history, signal_name='ask_history', dbus_interface=UnorderedHandler.IFACE, sender_keyword='sender', path=self.PATH)
-        self.tube.watch_participants(self.members_changed)
-
-        #Alternative implementation of members_changed (not yet working)
-        #self.tube.add_signal_receiver(self.members_changed, signal_name="MembersChanged", dbus_interface="org.freedesktop.Telepathy.Channel.Interface.Group")
-        
         if self.object is not None:
             self.ask_history()
 
@@ -257,10 +460,54 @@ class UnorderedHandler(ExportedGObject):
         necessary if one DObject wishes to create another."""
         return self._tube_box
     
-    @dbus.service.signal(dbus_interface=IFACE, signature='v')
+    def can_pack(self, names=None):
+        """Returns True if messages to the participants in names, or to all
+        participants if names is None, may be packed into byte arrays"""
+        is_packable = getattr(self.object, 'is_packable', None)
+        return (is_packable is not None) and is_packable() and self._mux.peers_support('packed', names)
+    
+    def _emit(self, message):
+        if isinstance(message, bytes):
+            self._mux.send_packed(message, rel_path=self._rel_path)
+        else:
+            self._mux.send(message, rel_path=self._rel_path)
+    
     def send(self, message):
         """This method broadcasts message to all other handlers for this UO"""
-        return
+        merge = getattr(self.object, 'merge_messages', None)
+        if (self._outbox_delay is None) or (merge is None):
+            self._emit(message)
+            return
+        self._outbox_lock.acquire()
+        if self._outbox is None:
+            self._outbox = message
+            self._outbox_source = GObject.timeout_add(int(self._outbox_delay * 1000), self._outbox_timeout)
+        else:
+            self._outbox = merge(self._outbox, message)
+        self._outbox_count += 1
+        full = self._outbox_count >= self._outbox_size
+        self._outbox_lock.release()
+        if full:
+            self.flush()
+    
+    def flush(self):
+        """Broadcast any messages waiting in the outbox immediately"""
+        self._outbox_lock.acquire()
+        message = self._outbox
+        self._outbox = None
+        self._outbox_count = 0
+        source = self._outbox_source
+        self._outbox_source = None
+        self._outbox_lock.release()
+        if source is not None:
+            GObject.source_remove(source)
+        if message is not None:
+            self._emit(message)
+    
+    def _outbox_timeout(self):
+        self._outbox_source = None  # GLib removes the source when we return False
+        self.flush()
+        return False
         
     def receive_message(self, message, sender=None):
         if self.object is None:
@@ -268,9 +515,65 @@ class UnorderedHandler(ExportedGObject):
         else:
             self.object.receive_message(message)
     
-    @dbus.service.signal(dbus_interface=IFACE, signature='')
     def ask_history(self):
-        return
+        self._awaiting_history = True
+        self._mux.ask_history(rel_path=self._rel_path)
+    
+    def _history_asked(self, sender=None):
+        self._unsettled.add(sender)
+        self._elect(sender)
+    
+    def _rank(self, name, newcomer):
+        """Every participant computes the same rank for name as a responder to
+        newcomer, but each newcomer gets a different ordering, which spreads
+        the work across the group."""
+        return zlib.crc32((name + " " + newcomer).encode())
+    
+    def _elect(self, newcomer):
+        """Tell our history to newcomer if we are one of the RESPONDERS best
+        ranked participants.  Otherwise, wait RESPONSE_TIMEOUT for each tier of
+        RESPONDERS above us, and then tell it anyway in case they were silent.
+        The wait is cancelled as soon as the newcomer announces that it has
+        received a history, so normally only the first tier replies.
+        
+        Participants that are still awaiting a history of their own are ranked
+        after all the others, so that their possibly empty histories are only
+        sent if nobody else has answered."""
+        try:
+            my_name = self.tube.get_unique_name()
+            if newcomer == my_name:
+                return
+            names = (self._mux.get_members() | set([my_name])) - set([newcomer])
+            unsettled = self._unsettled - set([my_name])
+            if self._awaiting_history:
+                unsettled.add(my_name)
+            ranked = sorted(names, key=lambda name: (name in unsettled, self._rank(name, newcomer)))
+            tier = ranked.index(my_name) // UnorderedHandler.RESPONDERS
+            self._cancel_fallback(newcomer)
+            if tier == 0:
+                self.tell_history(sender=newcomer)
+            else:
+                delay = int(tier * UnorderedHandler.RESPONSE_TIMEOUT * 1000)
+                self._fallbacks[newcomer] = GObject.timeout_add(delay, self._fallback, newcomer)
+        finally:
+            return
+    
+    def _fallback(self, newcomer):
+        self._fallbacks.pop(newcomer, None)
+        if newcomer in self._mux.get_members():
+            self.tell_history(sender=newcomer)
+        return False
+    
+    def _cancel_fallback(self, newcomer):
+        source = self._fallbacks.pop(newcomer, None)
+        if source is not None:
+            GObject.source_remove(source)
+    
+    def _history_received(self, sender=None):
+        """Callback for the UnorderedMux when sender announces that it has
+        received a history, so that nobody else needs to send one"""
+        self._unsettled.discard(sender)
+        self._cancel_fallback(sender)
     
     def tell_history(self, sender=None):
         self._logger.debug("tell_history to " + str(sender))
@@ -281,22 +584,58 @@ class UnorderedHandler(ExportedGObject):
                 self._logger.error("object not registered before tell_history")
                 return
             remote = self.tube.get_object(sender, self.PATH)
-            h = self.object.get_history()
-            remote.receive_history(h, reply_handler=PassFunction, error_handler=PassFunction)
+            packed = self.can_pack((sender,))
+            if hasattr(self.object, 'get_history_since'):
+                def digest_cb(digest):
+                    if packed:
+                        h = self.object.get_history_since(digest, packed=True)
+                    else:
+                        h = self.object.get_history_since(digest)
+                    # Sent even if empty, so that the newcomer announces
+                    # that it is up to date and the fallbacks stand down
+                    self._send_history(sender, remote, h)
+                def digest_error_cb(e):
+                    # The remote handler predates digests
+                    self._send_history(sender, remote, self.object.get_history())
+                remote.get_digest(reply_handler=digest_cb, error_handler=digest_error_cb)
+            elif packed:
+                self._send_history(sender, remote, self.object.get_history(packed=True))
+            else:
+                self._send_history(sender, remote, self.object.get_history())
         finally:
             return
     
-    @dbus.service.method(dbus_interface=IFACE, in_signature = 'v', out_signature='')
+    def _send_history(self, name, remote, h):
+        if isinstance(h, bytes):
+            if (len(h) > UnorderedHandler.COMPRESS_THRESHOLD) and self._mux.peers_support('zlib', (name,)):
+                remote.receive_compressed_history(dbus.ByteArray(zlib.compress(h)), reply_handler=PassFunction, error_handler=PassFunction)
+            else:
+                remote.receive_packed_history(h, reply_handler=PassFunction, error_handler=PassFunction)
+        else:
+            remote.receive_history(h, reply_handler=PassFunction, error_handler=PassFunction)
+    
+    def get_digest(self):
+        if hasattr(self.object, 'get_digest'):
+            return self.object.get_digest()
+        else:
+            return empty_digest()
+    
     def receive_history(self, hist):
         if self.object is None:
             self._logger.error("object not registered before receive_history")
             return
         self.object.add_history(hist)
+        if self._awaiting_history:
+            self._awaiting_history = False
+            self._mux.history_received(rel_path=self._rel_path)
 
     def members_changed(self, added, removed):
+        """Newcomers are served when they ask_history, so only departures
+        matter here"""
         self._logger.debug("members_changed")
-        for (handle, name) in added:
-            self.tell_history(sender=name)
+        for (handle, name) in removed:
+            self._unsettled.discard(name)
+            self._cancel_fallback(name)
     
     def __repr__(self):
         return 'UnorderedHandler(' + self._myname + ', ' + repr(self._tube_box) + ')'
@@ -305,11 +644,207 @@ class UnorderedHandler(ExportedGObject):
         """A convenience function for returning a new UnorderedHandler derived
         from this one, with a new name.  This is safe as long as copy() is called
         with a different name every time."""
-        return UnorderedHandler(self._myname + "/" + name, self._tube_box)
+        return UnorderedHandler(self._myname + "/" + name, self._tube_box, self._outbox_delay, self._outbox_size)
+
+class UnorderedMux(dbus.service.FallbackObject):
+    """An UnorderedMux carries the bus traffic of every UnorderedHandler in a
+    TubeBox.  It is exported once, as a fallback object for the parent of the
+    handlers' paths, and it registers one receiver for each signal and one
+    participant watch for all the handlers together.  Incoming messages are
+    routed to handlers by object path.  The paths, signals and methods seen on
+    the bus are the same as when each handler was exported on its own, so
+    peers running older versions still interoperate.
+    
+    Newer features are negotiated.  The mux asks every new participant for its
+    CAPABILITIES, and participants that do not answer are assumed to have
+    none.  Features that older peers would not understand use signals and
+    methods of their own, such as send_packed, which older peers ignore.
+    """
+    IFACE = UnorderedHandler.IFACE
+    PATH = UnorderedHandler.BASEPATH[:-1]
+    CAPABILITIES = ('packed', 'zlib')
+    
+    def __init__(self, tube_box):
+        dbus.service.FallbackObject.__init__(self)
+        self._logger = logging.getLogger(UnorderedMux.PATH)
+        self._handlers = {} # path -> UnorderedHandler
+        self._members = set() # unique names of the other participants
+        self._capabilities = {} # unique name -> set of capabilities
+        self._members_lock = threading.Lock()
+        self.tube = None
+        self.is_initiator = None
+        tube_box.register_listener(self.set_tube)
+    
+    def add(self, handler):
+        """Route the traffic for handler's path to handler"""
+        self._handlers[handler.get_path()] = handler
+        if self.tube is not None:
+            handler.set_tube(self.tube, self.is_initiator)
+    
+    def set_tube(self, tube, is_initiator):
+        """Callback for the TubeBox"""
+        self.tube = tube
+        self.is_initiator = is_initiator
+        self.add_to_connection(self.tube, UnorderedMux.PATH)
+        
+        self.tube.add_signal_receiver(self._receive_message, signal_name='send', dbus_interface=UnorderedMux.IFACE, sender_keyword='sender', path_keyword='path')
+        self.tube.add_signal_receiver(self._receive_message, signal_name='send_packed', dbus_interface=UnorderedMux.IFACE, sender_keyword='sender', path_keyword='path', byte_arrays=True)
+        self.tube.add_signal_receiver(self._history_asked, signal_name='ask_history', dbus_interface=UnorderedMux.IFACE, sender_keyword='sender', path_keyword='path')
+        self.tube.add_signal_receiver(self._history_received, signal_name='history_received', dbus_interface=UnorderedMux.IFACE, sender_keyword='sender', path_keyword='path')
+        for handler in list(self._handlers.values()):
+            handler.set_tube(tube, is_initiator)
+        self.tube.watch_participants(self._members_changed)
+    
+    def get_members(self):
+        """Returns the set of unique names of the other participants"""
+        self._members_lock.acquire()
+        members = set(self._members)
+        self._members_lock.release()
+        return members
+    
+    def peers_support(self, capability, names=None):
+        """Returns True if every participant in names, or every other
+        participant if names is None, has advertised capability"""
+        self._members_lock.acquire()
+        if names is None:
+            names = self._members
+        supported = all(capability in self._capabilities.get(name, ()) for name in names)
+        self._members_lock.release()
+        return supported
+    
+    def _members_changed(self, added, removed):
+        my_name = self.tube.get_unique_name()
+        added = [(handle, name) for (handle, name) in added if name != my_name]
+        self._members_lock.acquire()
+        self._members.update(name for (handle, name) in added)
+        for (handle, name) in removed:
+            self._members.discard(name)
+            self._capabilities.pop(name, None)
+        self._members_lock.release()
+        for (handle, name) in added:
+            self._ask_capabilities(name)
+        for handler in list(self._handlers.values()):
+            handler.members_changed(added, removed)
+    
+    def _ask_capabilities(self, name):
+        def reply_cb(capabilities):
+            self._members_lock.acquire()
+            if name in self._members:
+                self._capabilities[name] = set(str(c) for c in capabilities)
+            self._members_lock.release()
+        try:
+            remote = self.tube.get_object(name, UnorderedMux.PATH)
+            remote.get_capabilities(reply_handler=reply_cb, error_handler=PassFunction)
+        finally:
+            return
+    
+    def _receive_message(self, message, sender=None, path=None):
+        handler = self._handlers.get(path)
+        if handler is not None:
+            handler.receive_message(message, sender)
+    
+    def _history_asked(self, sender=None, path=None):
+        handler = self._handlers.get(path)
+        if handler is not None:
+            handler._history_asked(sender)
+    
+    def _history_received(self, sender=None, path=None):
+        handler = self._handlers.get(path)
+        if handler is not None:
+            handler._history_received(sender)
+    
+    @dbus.service.signal(dbus_interface=IFACE, signature='v', rel_path_keyword='rel_path')
+    def send(self, message, rel_path=None):
+        """Broadcast message from the handler at rel_path"""
+        return
+    
+    @dbus.service.signal(dbus_interface=IFACE, signature='ay', rel_path_keyword='rel_path')
+    def send_packed(self, message, rel_path=None):
+        """Broadcast a packed message from the handler at rel_path"""
+        return
+    
+    @dbus.service.signal(dbus_interface=IFACE, signature='', rel_path_keyword='rel_path')
+    def ask_history(self, rel_path=None):
+        return
+    
+    @dbus.service.signal(dbus_interface=IFACE, signature='', rel_path_keyword='rel_path')
+    def history_received(self, rel_path=None):
+        """Announce that the handler at rel_path has received a history after
+        asking for one.  Older peers ignore this signal."""
+        return
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature='', out_signature='as', rel_path_keyword='rel_path')
+    def get_capabilities(self, rel_path=None):
+        return dbus.Array(UnorderedMux.CAPABILITIES, signature='s')
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature='', out_signature='v', rel_path_keyword='rel_path')
+    def get_digest(self, rel_path=None):
+        handler = self._handlers.get(UnorderedMux.PATH + rel_path)
+        if handler is None:
+            return empty_digest()
+        return handler.get_digest()
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature = 'v', out_signature='', rel_path_keyword='rel_path')
+    def receive_history(self, hist, rel_path=None):
+        handler = self._handlers.get(UnorderedMux.PATH + rel_path)
+        if handler is None:
+            self._logger.error("no handler for history at " + rel_path)
+            return
+        handler.receive_history(hist)
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature = 'ay', out_signature='', rel_path_keyword='rel_path', byte_arrays=True)
+    def receive_packed_history(self, hist, rel_path=None):
+        self.receive_history(hist, rel_path)
+    
+    @dbus.service.method(dbus_interface=IFACE, in_signature = 'ay', out_signature='', rel_path_keyword='rel_path', byte_arrays=True)
+    def receive_compressed_history(self, hist, rel_path=None):
+        """Accepts a packed history that has been compressed with zlib"""
+        self.receive_history(dbus.ByteArray(zlib.decompress(hist)), rel_path)
 
 def empty_translator(x, pack):
     return x
 
+def encode_elements(els, translator, packer=None, packed=False):
+    """Encodes the elements els as a message.  If packed is True, the message
+    is a dbus.ByteArray of fixed-width records produced by packer.  Otherwise
+    it is a dbus.Array of the elements as encoded by translator."""
+    if packed:
+        return dbus.ByteArray(packer.pack(els))
+    elif len(els) > 0:
+        return dbus.Array([translator(el, True) for el in els])
+    else:
+        return dbus.Array([], type=dbus.Boolean) #prevent introspection of empty list, which fails
+
+def decode_elements(msg, translator, packer=None):
+    """Decodes a message produced by encode_elements into a list"""
+    if isinstance(msg, bytes):
+        return packer.unpack(msg)
+    else:
+        return [translator(el, False) for el in msg]
+
+def empty_digest():
+    """The digest of an empty set, which asks for the whole history"""
+    return dbus.Struct((dbus.Int32(0), dbus.UInt32(0)), signature='iu')
+
+def sorted_digest(L, translator):
+    """Returns the digest of the sorted sequence L, consisting of its length, its
+    checksum, and its last element."""
+    if len(L) == 0:
+        return empty_digest()
+    return dbus.Struct((dbus.Int32(len(L)), dbus.UInt32(checksum(L)), translator(L[-1], True)))
+
+def sorted_history_since(L, digest, translator):
+    """Returns the elements of the sorted sequence L that a participant with the
+    given digest is missing.  If that participant's set is exactly the part
+    of L up to its last element, only the rest of L is needed.  Otherwise the
+    sets have diverged, e.g. after a split, and all of L is returned."""
+    n = int(digest[0])
+    if n > 0:
+        i = bisect.bisect_right(L, translator(digest[2], False))
+        if (i == n) and (checksum(L[:i]) == int(digest[1])):
+            return L[i:]
+    return L
+
 class HighScore:
     """ A HighScore is the simplest nontrivial DObject.  A HighScore's state consists
     of a value and a score.  The user may suggest a new value and score.  If the new
@@ -362,6 +897,13 @@ class HighScore:
     
     add_history = receive_message
     
+    def merge_messages(self, a, b):
+        """Only the message with the higher score matters"""
+        if self._score_trans(b[1], False) >= self._score_trans(a[1], False):
+            return b
+        else:
+            return a
+    
     def set_value(self, val, score):
         """This method suggests a value and score for this HighScore.  If the
         suggested score is higher than the current score, then both value and
@@ -448,6 +990,14 @@ def float_translator(f, pack):
     else:
         return float(f)
 
+def ns_translator(n, pack):
+    """This translator sends integer nanoseconds as float seconds, which
+    peers convert back exactly as long as n came from exact_ns()"""
+    if pack:
+        return dbus.Double(ns_to_seconds(n))
+    else:
+        return seconds_to_ns(n)
+
 def string_translator(s, pack):
     """This translator packs and unpacks unicode strings for dbus serialization"""
     if pack:
@@ -498,20 +1048,43 @@ class Latest:
         for L in self._listeners:
             L(val)
 
+def _delegate(name):
+    """Returns a method that forwards the special method name to self._list.
+    Python looks special methods up on the class rather than the instance, so
+    the bindings made in AddOnlySet.__init__ do not reach len(), iter(), in,
+    indexing or the operators on their own."""
+    def method(self, *args):
+        return getattr(self._list, name)(*args)
+    method.__name__ = name
+    return method
+
+_SET_SPECIALS = ('__and__', '__contains__', '__eq__', '__ge__', '__gt__',
+                 '__iter__', '__le__', '__len__', '__lt__', '__ne__', '__or__',
+                 '__rand__', '__ror__', '__rsub__', '__rxor__', '__sub__',
+                 '__xor__')
+
 class AddOnlySet(ListSet):
     """The AddOnlySet is the archetypal UnorderedObject.  It consists of a set,
     supporting all the normal Python set operations except those that cause an
     item to be removed from the set.  Thanks to this restriction, a AddOnlySet
     is perfectly coherent, since the order in which elements are added is not
     important.
+    
+    If the elements are fixed-width numeric records, record_format may give
+    their layout as a struct format, such as 'd' for floats.  Messages to peers
+    that support it are then packed into a single byte array, which is much
+    cheaper to marshal than an array of variants.
     """
-    def __init__(self, handler, initset = (), translator=empty_translator):
+    def __init__(self, handler, initset = (), translator=empty_translator, record_format=None):
         self._logger = logging.getLogger('dobject.AddOnlySet')
         self._list = set(initset)
         
         self._lock = threading.Lock()
 
         self._trans = translator
+        self._packer = None
+        if record_format is not None:
+            self._packer = RecordPacker(record_format)
         self._listeners = []  #This must be done before registering with the handler
 
         self._handler = handler
@@ -569,7 +1142,9 @@ class AddOnlySet(ListSet):
             self._list.update(d)
             self._send(d)
     
-    __ior__ = update
+    def __ior__(self, y):
+        self.update(y)
+        return self
     
     def add(self, y):
         """ Add the single element y to the current set.  If y is not already
@@ -578,9 +1153,25 @@ class AddOnlySet(ListSet):
             self._list.add(y)
             self._send((y,))
     
+    def is_packable(self):
+        return self._packer is not None
+    
+    def _encode(self, els, packed=False):
+        return encode_elements(els, self._trans, self._packer, packed)
+    
+    def _decode(self, msg):
+        return decode_elements(msg, self._trans, self._packer)
+    
     def _send(self, els):
         if len(els) > 0:
-            self._handler.send(dbus.Array([self._trans(el, True) for el in els]))
+            self._handler.send(self._encode(list(els), self._handler.can_pack()))
+    
+    def merge_messages(self, a, b):
+        """The union of two messages is their concatenation, since only new
+        elements are ever sent"""
+        if isinstance(a, bytes) and isinstance(b, bytes):
+            return dbus.ByteArray(a + b)
+        return self._encode(self._decode(a) + self._decode(b))
     
     def _net_update(self, y):
         s = set(y)
@@ -590,13 +1181,16 @@ class AddOnlySet(ListSet):
             self._trigger(d)
     
     def receive_message(self, msg):
-        self._net_update((self._trans(el, False) for el in msg))
+        self._net_update(self._decode(msg))
     
-    def get_history(self):
-        if len(self._list) > 0:
-            return dbus.Array([self._trans(el, True) for el in self._list])
-        else:
-            return dbus.Array([], type=dbus.Boolean) #Prevent introspection of empty list, which fails 
+    def get_history(self, packed=False):
+        return self._encode(list(self._list), packed)
+    
+    def get_digest(self):
+        return sorted_digest(sorted(self._list), self._trans)
+    
+    def get_history_since(self, digest, packed=False):
+        return self._encode(sorted_history_since(sorted(self._list), digest, self._trans), packed)
     
     add_history = receive_message
     
@@ -613,6 +1207,9 @@ class AddOnlySet(ListSet):
     def __repr__(self):
         return 'AddOnlySet(' + repr(self._handler) + ', ' + repr(self._list) + ', ' + repr(self._trans) + ')'
 
+for _name in _SET_SPECIALS:
+    setattr(AddOnlySet, _name, _delegate(_name))
+
 class AddOnlySortedSet(ListSet):
     """ AddOnlySortedSet is much like AddOnlySet, only backed by a ListSet, which
     provides a set for objects that are ordered under cmp().  Items are maintained
@@ -620,13 +1217,22 @@ class AddOnlySortedSet(ListSet):
     and the messages are subject to a time-like ordering.  Messages may still
     arrive out of order, but they will be stored in the same order on each
     computer.
+    
+    record_format has the same meaning as for AddOnlySet.  If NumPy is
+    available, the set is stored as a compact RecordSet of that layout, and
+    packed messages are merged into it without decoding each element.
     """
-    def __init__(self, handler, initset = (), translator=empty_translator):
+    def __init__(self, handler, initset = (), translator=empty_translator, record_format=None):
         self._logger = logging.getLogger('dobject.AddOnlySortedSet')
-        self._list = ListSet(initset)
+        self._record_format = record_format
+        self._list = sorted_set(initset, record_format)
         
         self._lock = threading.Lock()
         self._trans = translator
+        self._packer = None
+        if record_format is not None:
+            self._packer = RecordPacker(record_format)
+        self._floor = None
         self._listeners = []  #This must be done before registering with the handler
         self._handler = handler
         self._handler.register(self)
@@ -685,42 +1291,95 @@ class AddOnlySortedSet(ListSet):
     def update(self, y):
         """Add all the elements of an iterable y to the current set.  If any of
         these elements were not already present, they will be broadcast to all
-        other users."""
-        d = ListSet(y)
+        other users in a single message.  Returns a ListSet of the elements that
+        were new, so that callers can find the earliest change."""
+        d = sorted_set(y, self._record_format)
+        if self._floor is not None:
+            del d[:d.position(self._floor)]
         d -= self._list
         if len(d) > 0:
-            self._list.update(d)
+            self._list |= d
             self._send(d)
+        return d
     
-    __ior__ = update
+    def __ior__(self, y):
+        self.update(y)
+        return self
     
     def add(self, y):
         """ Add the single element y to the current set.  If y is not already
         present, it will be broadcast to all other users."""
+        if (self._floor is not None) and (y < self._floor):
+            return
         if y not in self._list:
             self._list.add(y)
             self._send((y,))
     
+    def set_floor(self, floor):
+        """Forget every item less than floor, and ignore any such items that
+        are added later.  This is the one exception to the add-only rule, and
+        is only safe once every participant agrees that those items are
+        obsolete, e.g. because they have been folded into some other DObject.
+        The floor never decreases."""
+        if (self._floor is not None) and (floor <= self._floor):
+            return
+        self._floor = floor
+        del self._list[:self._list.position(floor)]
+    
+    def is_packable(self):
+        return self._packer is not None
+    
+    def _encode(self, els, packed=False):
+        if packed and isinstance(els, RecordSet):
+            return dbus.ByteArray(els.tobytes())
+        return encode_elements(els, self._trans, self._packer, packed)
+    
+    def _decode(self, msg):
+        return decode_elements(msg, self._trans, self._packer)
+    
+    def _decode_set(self, msg):
+        """Decodes msg into a set of the same kind as self._list.  Packed
+        messages go straight into a RecordSet, with no Python object per
+        element."""
+        if isinstance(msg, bytes) and isinstance(self._list, RecordSet):
+            d = RecordSet(self._record_format)
+            d.frombytes(msg)
+            return d
+        return sorted_set(self._decode(msg), self._record_format)
+    
     def _send(self, els):
         if len(els) > 0:
-            self._handler.send(dbus.Array([self._trans(el, True) for el in els]))
-    
-    def _net_update(self, y):
-        d = ListSet()
-        d._list = y
+            self._handler.send(self._encode(els, self._handler.can_pack()))
+    
+    def merge_messages(self, a, b):
+        """Receivers expect the elements of each message in order, so the
+        union is formed by merging the sorted elements"""
+        if isinstance(a, bytes) and isinstance(b, bytes) and isinstance(self._list, RecordSet):
+            d = self._decode_set(a)
+            d.frombytes(b)
+            return self._encode(d, True)
+        L = merge_or(self._decode(a), self._decode(b))
+        return self._encode(L, isinstance(a, bytes) and isinstance(b, bytes))
+    
+    def _net_update(self, d):
+        if self._floor is not None:
+            del d[:d.position(self._floor)]
         d -= self._list
         if len(d) > 0:
             self._list |= d
             self._trigger(d)
     
     def receive_message(self, msg):
-        self._net_update([self._trans(el, False) for el in msg])
+        self._net_update(self._decode_set(msg))
     
-    def get_history(self):
-        if len(self._list._list) > 0:
-            return dbus.Array([self._trans(el, True) for el in self._list._list])
-        else:
-            return dbus.Array([], type=dbus.Boolean) #prevent introspection of empty list, which fails
+    def get_history(self, packed=False):
+        return self._encode(self._list, packed)
+    
+    def get_digest(self):
+        return sorted_digest(self._list, self._trans)
+    
+    def get_history_since(self, digest, packed=False):
+        return self._encode(sorted_history_since(self._list, digest, self._trans), packed)
     
     add_history = receive_message
     
@@ -736,6 +1395,9 @@ class AddOnlySortedSet(ListSet):
     
     def __repr__(self):
         return 'AddOnlySortedSet(' + repr(self._handler) + ', ' + repr(self._list) + ', ' + repr(self._trans) + ')'
+
+for _name in _SET_SPECIALS + ('__getitem__', '__reversed__'):
+    setattr(AddOnlySortedSet, _name, _delegate(_name))
         
         
 def CausalHandler():
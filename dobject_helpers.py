@@ -18,6 +18,16 @@ along with DObject.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import bisect
+import itertools
+import math
+import struct
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
 dobject_helpers is a collection of functions and data structures that are useful
@@ -78,6 +88,8 @@ def merge_sub(a,b):
 
 def kill_dupes(a): #assumes a is sorted
     """Internal helper function for removing duplicates in a sorted list"""
+    if len(a) == 0:
+        return []
     prev = a[0]
     out = [prev]
     for i in range(1, len(a)):
@@ -87,6 +99,93 @@ def kill_dupes(a): #assumes a is sorted
             prev = item
     return out
 
+def checksum(a):
+    """Return an order-independent 32-bit checksum of the items in a.  Items
+    are identified by their repr(), so the checksum is the same on every
+    computer for sets of numbers, strings and tuples of them."""
+    c = 0
+    for item in a:
+        c += zlib.crc32(repr(item).encode())
+    return c & 0xffffffff
+
+def seconds_to_ns(s):
+    """Converts float seconds to the nearest integer nanoseconds, exactly.
+    Infinities are returned unchanged."""
+    s = float(s)
+    if math.isinf(s):
+        return s
+    (p, q) = s.as_integer_ratio()
+    return (2 * p * 10**9 + q) // (2 * q)
+
+def ns_to_seconds(n):
+    """Converts integer nanoseconds to the nearest float seconds"""
+    return n / 10**9
+
+def exact_ns(n):
+    """Returns the integer nanoseconds nearest to n that survive a round trip
+    through float seconds, i.e. seconds_to_ns(ns_to_seconds(exact_ns(n))) is
+    exact_ns(n).  For durations this is n itself.  For dates, whose floats are
+    coarser than a nanosecond, it is the nanosecond nearest to a float, so that
+    peers that still send float seconds agree exactly on every value."""
+    return seconds_to_ns(ns_to_seconds(n))
+
+def _boottime_ns():
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+try:
+    _boottime_ns()
+    _counter_ns = _boottime_ns
+except (AttributeError, OSError):  # not Linux, or a kernel older than 2.6.39
+    _counter_ns = time.monotonic_ns
+
+class MonotonicClock:
+    """A MonotonicClock tells the local wall-clock time, but never steps.  The
+    system's boot-time nanosecond counter is anchored to the wall clock once,
+    when the MonotonicClock is created, so later changes to the system clock,
+    e.g. by NTP or by hand, do not move it.  Reads are a single counter read and
+    an integer addition.
+    
+    CLOCK_BOOTTIME is used rather than CLOCK_MONOTONIC because it keeps counting
+    while the machine is suspended, which powerd does whenever no watch is
+    running.  Where CLOCK_BOOTTIME is missing, the monotonic counter is used.
+    """
+    def __init__(self):
+        self._anchor = time.time_ns() - _counter_ns()
+    
+    def time_ns(self):
+        """Returns the local time in integer nanoseconds since the epoch"""
+        return _counter_ns() + self._anchor
+    
+    def time(self):
+        """Returns the local time in seconds since the epoch"""
+        return (_counter_ns() + self._anchor) / 1e9
+
+class RecordPacker:
+    """A RecordPacker converts a sequence of fixed-width numeric records to and
+    from a compact little-endian byte string.  The record layout is given as a
+    struct format, such as 'd' for floats or 'di' for (float, int) tuples.
+    Records with a single field are plain values rather than 1-tuples.
+    """
+    def __init__(self, fmt):
+        self._fmt = fmt
+        self._struct = struct.Struct('<' + fmt)
+        self._scalar = len(self._struct.unpack(bytes(self._struct.size))) == 1
+    
+    def pack(self, records):
+        if self._scalar:
+            L = list(records)
+            return struct.pack('<%d%s' % (len(L), self._fmt), *L)
+        else:
+            p = self._struct.pack
+            return b''.join([p(*r) for r in records])
+    
+    def unpack(self, data):
+        if self._scalar:
+            n = len(data) // self._struct.size
+            return list(struct.unpack('<%d%s' % (n, self._fmt), data))
+        else:
+            return list(self._struct.iter_unpack(data))
+
 class Comparable:
     """Currently, ListSet does not provide a mechanism for specifying a
     comparator.  Users who would like to specify a comparator other than the one
@@ -101,54 +200,179 @@ class Comparable:
 
 class ListSet:
     """ListSet is a sorted set for comparable items.  It is inspired by the
-    Java Standard Library's TreeSet.  However, it is implemented by a sorted
-    list.  This implementation is much slower than a balanced binary tree, but
-    has the distinct advantage that I can actually implement it.
+    Java Standard Library's TreeSet.  It is implemented as a list of short
+    sorted lists, or chunks, much like a B-tree of height two.  The largest item
+    of each chunk is kept in _maxes, so finding the chunk that holds an item is
+    a bisection, and a Fenwick tree of the chunk lengths in _index turns a chunk
+    number into a position.  Insertion, removal, membership, position() and
+    indexing are therefore O(log n), plus a memmove of at most 2*LOAD pointers.
+    Bulk operations with many items merge whole lists instead.
     
     The methods of ListSet are all drawn directly from Python's set API,
     Python's list API, and Java's SortedSet API.
     """
+    LOAD = 1000  # chunks are split when they grow past twice this length
+    
     def __init__(self, seq=[]):
         L = list(seq)
         if len(L) > 1:
             L.sort()
             L = kill_dupes(L)
-        self._list = L
-
+        self._set_list(L)
+    
+    def _set_list(self, L):
+        """Replaces the contents with the sorted, duplicate-free list L"""
+        n = self.LOAD
+        self._lists = [L[i:i+n] for i in range(0, len(L), n)]
+        self._maxes = [c[-1] for c in self._lists]
+        self._len = len(L)
+        self._index = None
+    
+    def _flat(self):
+        """Returns the contents as a new sorted list"""
+        L = []
+        for c in self._lists:
+            L.extend(c)
+        return L
+    
+    def _build_index(self):
+        m = len(self._lists)
+        t = [0]
+        t.extend([len(c) for c in self._lists])
+        for i in range(1, m + 1):
+            j = i + (i & -i)
+            if j <= m:
+                t[j] += t[i]
+        self._index = t
+        return t
+    
+    def _offset(self, k):
+        """Returns the position of the first item of chunk k"""
+        t = self._index
+        if t is None:
+            t = self._build_index()
+        s = 0
+        while k > 0:
+            s += t[k]
+            k -= k & -k
+        return s
+    
+    def _locate(self, pos):
+        """Returns (k, i) such that the item at position pos is
+        self._lists[k][i].  pos must be in range."""
+        t = self._index
+        if t is None:
+            t = self._build_index()
+        k = 0
+        step = 1 << ((len(t) - 1).bit_length() - 1)
+        while step > 0:
+            j = k + step
+            if j < len(t) and t[j] <= pos:
+                k = j
+                pos -= t[j]
+            step >>= 1
+        return (k, pos)
+    
+    def _find(self, item):
+        """Returns (k, i) such that item is self._lists[k][i], or None"""
+        k = bisect.bisect_left(self._maxes, item)
+        if k < len(self._maxes):
+            c = self._lists[k]
+            i = bisect.bisect_left(c, item)
+            if c[i] == item:
+                return (k, i)
+        return None
+    
+    def _resized(self, k, delta):
+        """Accounts for a change of delta in the length of chunk k, splitting
+        the chunk if it has grown too long and dropping it if it is empty"""
+        c = self._lists[k]
+        if len(c) > 2 * self.LOAD:
+            self._lists[k:k+1] = [c[:self.LOAD], c[self.LOAD:]]
+            self._maxes[k:k+1] = [c[self.LOAD - 1], c[-1]]
+            self._index = None
+        elif len(c) == 0:
+            del self._lists[k]
+            del self._maxes[k]
+            self._index = None
+        else:
+            self._maxes[k] = c[-1]
+            t = self._index
+            if t is not None:
+                i = k + 1
+                while i < len(t):
+                    t[i] += delta
+                    i += i & -i
+    
+    def _delete(self, k, i):
+        del self._lists[k][i]
+        self._len -= 1
+        self._resized(k, -1)
+    
+    def _normalize(self, i):
+        if i < 0:
+            i += self._len
+        if not (0 <= i < self._len):
+            raise IndexError("ListSet index out of range")
+        return i
+    
+    def _range(self, start, stop):
+        """Returns the items from position start up to stop as a list"""
+        if start >= stop:
+            return []
+        (k, i) = self._locate(start)
+        (l, j) = self._locate(stop - 1)
+        if k == l:
+            return self._lists[k][i:j+1]
+        L = self._lists[k][i:]
+        for c in self._lists[k+1:l]:
+            L.extend(c)
+        L.extend(self._lists[l][:j+1])
+        return L
+    
+    def _merge(self, L):
+        """Adds the items of the sorted, duplicate-free list L.  A few items are
+        inserted one at a time; many are added by a single sort of the
+        concatenated lists, which timsort merges in linear time."""
+        if len(L) * 32 < self._len:
+            for x in L:
+                self.add(x)
+        else:
+            L = [x for x in L if self._find(x) is None]
+            if len(L) > 0:
+                M = self._flat()
+                M.extend(L)
+                M.sort()
+                self._set_list(M)
+    
     def __and__(self, someset):
         if someset.__class__ == self.__class__:
-            L = merge_and(self._list, someset._list)
+            L = merge_and(self._flat(), someset._flat())
         else:
             L = []
-            for x in self._list:
+            for x in self:
                 if x in someset:
                     L.append(x)
         a = ListSet()
-        a._list = L
+        a._set_list(L)
         return a
     
     def __contains__(self, item):
-        if len(self._list) == 0:
-            return False
-        if self._list[0] <= item <= self._list[-1]:
-            a = bisect.bisect_left(self._list, item)
-            return item == self._list[a]
-        else:
-            return False
+        return self._find(item) is not None
     
     def __eq__(self, someset):
         if someset.__class__ == self.__class__:
-            return self._list == someset._list
+            return (self._len == someset._len) and (self._flat() == someset._flat())
         else:
             return len(self.symmetric_difference(someset)) == 0
     
     def __ge__(self, someset):
         if someset.__class__ == self.__class__:
-            return len(merge_or(self._list, someset._list)) == len(self._list)
+            return len(merge_or(self._flat(), someset._flat())) == self._len
         else:
             a = len(someset)
             k = 0
-            for i in self._list:
+            for i in self:
                 if i in someset:
                     k += 1
             return k == a
@@ -158,48 +382,49 @@ class ListSet:
 
     def __iand__(self, someset):
         if someset.__class__ == self.__class__:
-            self._list = merge_and(self._list, someset._list)
+            self._set_list(merge_and(self._flat(), someset._flat()))
         else:
             L = []
-            for i in self._list:
+            for i in self:
                 if i in someset:
                     L.append(i)
-            self._list = L
+            self._set_list(L)
         return self
     
     def __ior__(self, someset):
-        if someset.__class__ == self.__class__:
-            self._list = merge_or(self._list, someset._list)
-        else:
-            self.update(someset)
+        self.update(someset)
         return self
     
     def __isub__(self, someset):
-        if someset.__class__ == self.__class__:
-            self._list = merge_sub(self._list, someset._list)
+        if (someset.__class__ == self.__class__) and (self._len * 32 >= someset._len):
+            self.difference_update(someset)
         else:
+            # Few items of our own: look each one up in someset
             L = []
-            for i in self._list:
+            for i in self:
                 if i not in someset:
                     L.append(i)
-            self._list = L
+            self._set_list(L)
         return self
     
     def __iter__(self):
-        return self._list.__iter__()
+        return itertools.chain.from_iterable(self._lists)
+    
+    def __reversed__(self):
+        return itertools.chain.from_iterable(map(reversed, reversed(self._lists)))
     
     def __ixor__(self, someset):
         if someset.__class__ == self.__class__:
-            self._list = merge_xor(self._list, someset._list)
+            self._set_list(merge_xor(self._flat(), someset._flat()))
         else:
             self.symmetric_difference_update(someset)
         return self
     
     def __le__(self, someset):
         if someset.__class__ == self.__class__:
-            return len(merge_or(self._list, someset._list)) == len(someset._list)
+            return len(merge_or(self._flat(), someset._flat())) == someset._len
         else:
-            for i in self._list:
+            for i in self:
                 if i not in someset:
                    return False
             return True
@@ -211,49 +436,34 @@ class ListSet:
         return not (self == someset)
     
     def __len__(self):
-        return len(self._list)
+        return self._len
     
     def __or__(self, someset):
-        a = ListSet()
-        if someset.__class__ == self.__class__:
-            a._list = merge_or(self._list, someset._list)
-        else:
-            a._list = self._list
-            a.update(someset)
+        a = self.copy()
+        a.update(someset)
         return a
     
     __rand__ = __and__
     
     def __repr__(self):
-        return "ListSet(" + repr(self._list) +")"
+        return "ListSet(" + repr(self._flat()) +")"
     
     __ror__ = __or__
     
     def __rsub__(self, someset):
-        if someset.__class__ == self.__class__:
-            a = ListSet()
-            a._list = merge_sub(someset._list, self._list)
-        else:
-            a = ListSet(someset)
-            a._list = merge_sub(a._list, self._list)
+        a = ListSet(someset)
+        a -= self
         return a
     
     def __sub__(self, someset):
-        a = ListSet()
-        if someset.__class__ == self.__class__:
-            a._list = merge_sub(self._list, someset._list)
-        else:
-            L = []
-            for i in self._list:
-                if i not in someset:
-                    L.append(i)
-            a._list = L
+        a = self.copy()
+        a -= someset
         return a
     
     def __xor__(self, someset):
         if someset.__class__ == self.__class__:
             a = ListSet()
-            a._list = merge_xor(self._list, someset._list)
+            a._set_list(merge_xor(self._flat(), someset._flat()))
         else:
             a = self.symmetric_difference(someset)
         return a
@@ -261,141 +471,453 @@ class ListSet:
     __rxor__ = __xor__
     
     def add(self, item):
-        if (len(self._list) > 0) and (item <= self._list[-1]):
-            a = bisect.bisect_left(self._list, item)
-            if self._list[a] != item:
-                self._list.insert(a, item)
+        if len(self._maxes) == 0:
+            self._set_list([item])
+            return
+        k = bisect.bisect_left(self._maxes, item)
+        if k == len(self._maxes):
+            k -= 1
+            self._lists[k].append(item)
         else:
-            self._list.append(item)
+            c = self._lists[k]
+            i = bisect.bisect_left(c, item)
+            if c[i] == item:
+                return
+            c.insert(i, item)
+        self._len += 1
+        self._resized(k, 1)
     
     def clear(self):
-        self._list = []
+        self._set_list([])
     
     def copy(self):
         a = ListSet()
-        a._list = list(self._list) #shallow copy
+        a._lists = [list(c) for c in self._lists] #shallow copy
+        a._maxes = list(self._maxes)
+        a._len = self._len
         return a
     
     def difference(self, iterable):
-        L = list(iterable)
-        L.sort()
-        a = ListSet()
-        a._list = merge_sub(self._list, kill_dupes(L))
+        a = self.copy()
+        a.difference_update(iterable)
         return a
     
     def difference_update(self, iterable):
         L = list(iterable)
-        L.sort()
-        self._list = merge_sub(self._list, kill_dupes(L))
+        if len(L) * 32 < self._len:
+            for x in L:
+                self.discard(x)
+        elif len(L) > 0:
+            L.sort()
+            self._set_list(merge_sub(self._flat(), kill_dupes(L)))
     
     def discard(self, item):
-        if (len(self._list) > 0) and (item <= self._list[-1]):
-            a = bisect.bisect_left(self._list, item)
-            if self._list[a] == item:
-                self._list.remove(a)
+        loc = self._find(item)
+        if loc is not None:
+            self._delete(*loc)
     
     def intersection(self, iterable):
         L = list(iterable)
         L.sort()
         a = ListSet()
-        a._list = merge_and(self._list, kill_dupes(L))
+        a._set_list(merge_and(self._flat(), kill_dupes(L)))
+        return a
     
     def intersection_update(self, iterable):
         L = list(iterable)
         L.sort()
-        self._list = merge_and(self._list, kill_dupes(L))
+        self._set_list(merge_and(self._flat(), kill_dupes(L)))
     
     def issuperset(self, iterable):
-        L = list(iterable)
-        L.sort()
-        m = merge_or(self._list, kill_dupes(L))
-        return len(m) == len(self._list)
+        for x in iterable:
+            if x not in self:
+                return False
+        return True
     
     def issubset(self, iterable):
         L = list(iterable)
         L.sort()
         L = kill_dupes(L)
-        m = merge_or(self._list, L)
+        m = merge_or(self._flat(), L)
         return len(m) == len(L)
     
     def pop(self, i = None):
         if i == None:
-            return self._list.pop()
-        else:
-            return self._list.pop(i)
+            i = -1
+        (k, j) = self._locate(self._normalize(i))
+        item = self._lists[k][j]
+        self._delete(k, j)
+        return item
         
     def remove(self, item):
-        if (len(self._list) > 0) and (item <= self._list[-1]):
-            a = bisect.bisect_left(self._list, item)
-            if self._list[a] == item:
-                self._list.remove(a)
-                return
-        raise KeyError("Item is not in the set")
+        loc = self._find(item)
+        if loc is None:
+            raise KeyError("Item is not in the set")
+        self._delete(*loc)
     
     def symmetric_difference(self, iterable):
         L = list(iterable)
         L.sort()
         a = ListSet()
-        a._list = merge_xor(self._list, kill_dupes(L))
+        a._set_list(merge_xor(self._flat(), kill_dupes(L)))
         return a
     
     def symmetric_difference_update(self, iterable):
         L = list(iterable)
         L.sort()
-        self._list = merge_xor(self._list, kill_dupes(L))
+        self._set_list(merge_xor(self._flat(), kill_dupes(L)))
     
     def union(self, iterable):
-        L = list(iterable)
-        L.sort()
-        a = ListSet()
-        a._list = merge_or(self._list, kill_dupes(L))
+        a = self.copy()
+        a.update(iterable)
+        return a
     
     def update(self, iterable):
-        L = list(iterable)
-        L.sort()
-        self._list = merge_or(self._list, kill_dupes(L))
+        if iterable.__class__ == self.__class__:
+            L = iterable._flat()
+        else:
+            L = list(iterable)
+            L.sort()
+            L = kill_dupes(L)
+        self._merge(L)
     
     def __getitem__(self, key):
-        if type(key) == int:
-            return self._list.__getitem__(key)
-        elif type(key) == slice:
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self._len)
+            if step == 1:
+                L = self._range(start, stop)
+            else:
+                L = self._flat()[key]
+                if step < 0:
+                    L.reverse()
             a = ListSet()
-            L = self._list.__getitem__(key)
-            if key.step < 0:
-                L.reverse()
-            a._list = L
+            a._set_list(L)
             return a
+        else:
+            (k, i) = self._locate(self._normalize(key))
+            return self._lists[k][i]
     
     def __delitem__(self, key):
-        self._list.__delitem__(key)
-    
-    def index(self, x, i=0, j=-1):
-        if (len(self._list) > 0) and (x <= self._list[-1]):
-            a = bisect.bisect_left(self._list, x, i, j)
-            if self._list[a] == x:
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self._len)
+            if step != 1:
+                L = self._flat()
+                del L[key]
+                self._set_list(L)
+            elif start < stop:
+                (k, i) = self._locate(start)
+                (l, j) = self._locate(stop - 1)
+                self._len -= stop - start
+                if k == l:
+                    del self._lists[k][i:j+1]
+                    self._resized(k, start - stop)
+                else:
+                    del self._lists[l][:j+1]
+                    del self._lists[k][i:]
+                    del self._lists[k+1:l]
+                    self._lists = [c for c in self._lists if len(c) > 0]
+                    self._maxes = [c[-1] for c in self._lists]
+                    self._index = None
+        else:
+            (k, i) = self._locate(self._normalize(key))
+            self._delete(k, i)
+    
+    def index(self, x, i=0, j=None):
+        loc = self._find(x)
+        if loc is not None:
+            a = self._offset(loc[0]) + loc[1]
+            if (i <= a) and ((j is None) or (a < j)):
                 return a
         raise ValueError("Item not found")
     
-    def position(self, x, i=0, j=-1):
-        return bisect.bisect_left(self._list, x, i, j)
+    def position(self, x, i=0, j=None):
+        """Returns the number of items less than x, clamped to [i, j] like
+        bisect_left"""
+        k = bisect.bisect_left(self._maxes, x)
+        if k == len(self._maxes):
+            a = self._len
+        else:
+            a = self._offset(k) + bisect.bisect_left(self._lists[k], x)
+        if j is not None:
+            a = min(a, j)
+        return max(a, i)
     
     def subset(self, x, y):
-        a = bisect.bisect_left(self._list, x)
-        b = bisect.bisect_left(self._list, y)
         s = ListSet()
-        s._list = self._list[a:b]
+        s._set_list(self._range(self.position(x), self.position(y)))
         return s
     
     def first(self):
-        return self._list[0]
+        return self._lists[0][0]
     
     def last(self):
-        return self._list[-1]
+        return self._lists[-1][-1]
     
     def headset(self, x):
-        a = bisect.bisect_left(self._list, x, i, j)
-        return self[:a]
+        return self[:self.position(x)]
     
     def tailset(self, x):
-        a = bisect.bisect_left(self._list, x, i, j)
-        return self[a:]
+        return self[self.position(x):]
+
+def _record_dtype(fmt):
+    """Returns the NumPy dtype with the same layout as the struct format fmt,
+    or None if there is none"""
+    if (numpy is None) or (not fmt.isalpha()):
+        return None
+    try:
+        if len(fmt) == 1:
+            dtype = numpy.dtype('<' + fmt)
+        else:
+            dtype = numpy.dtype([('f%d' % i, '<' + c) for (i, c) in enumerate(fmt)])
+    except TypeError:
+        return None
+    if dtype.itemsize != struct.calcsize('<' + fmt):
+        return None
+    return dtype
+
+def _sort_unique(a):
+    """Returns the items of the array a sorted and without duplicates.  Records
+    are ordered by a lexsort of their fields, which compares natively."""
+    if a.dtype.names is None:
+        a = numpy.sort(a)
+    else:
+        a = a[numpy.lexsort([a[f] for f in reversed(a.dtype.names)])]
+    if len(a) > 1:
+        a = a[numpy.concatenate(([True], a[1:] != a[:-1]))]
+    return a
+
+def _search(a, b):
+    """Returns the positions at which the items of the sorted array b belong in
+    the sorted array a, and a boolean mask of the items of b that are already
+    in a.  Only the first field of each record is searched, natively; the few
+    items of b whose first field also occurs in a are then searched again
+    record by record."""
+    if a.dtype.names is None:
+        i = numpy.searchsorted(a, b)
+        return (i, numpy.searchsorted(a, b, 'right') > i)
+    f = a.dtype.names[0]
+    i = numpy.searchsorted(a[f], b[f])
+    j = numpy.searchsorted(a[f], b[f], 'right')
+    found = numpy.zeros(len(b), dtype=bool)
+    tie = j > i
+    if tie.any():
+        k = numpy.searchsorted(a, b[tie])
+        i[tie] = k
+        found[tie] = (k < j[tie]) & (a[numpy.minimum(k, len(a) - 1)] == b[tie])
+    return (i, found)
+
+class RecordSet(ListSet):
+    """A RecordSet is a ListSet of fixed-width numeric records, such as the
+    (time, event) tuples of a stopwatch, stored in a NumPy structured array
+    rather than as Python objects.  The layout is given as a struct format, as
+    for RecordPacker, so a 'qi' record takes 12 bytes.  Records with a single
+    field are plain values.  Items added to a RecordSet are converted to the
+    layout, so a float added to an integer field is truncated.
+    
+    Single items are found by bisection and inserted by shifting the tail of the
+    array, so adding near the end, as new events usually are, is cheap.  Bulk
+    operations with other RecordSets and with packed bytes, as produced by
+    RecordPacker, are vectorised with searchsorted and run at C speed.
+    
+    RecordSet requires NumPy.  sorted_set() falls back to a ListSet when NumPy
+    is missing or cannot represent the layout.
+    """
+    def __init__(self, fmt, seq=()):
+        self.format = fmt
+        self._dtype = _record_dtype(fmt)
+        if self._dtype is None:
+            raise ValueError("Unsupported record format " + repr(fmt))
+        self._set_array(self._to_array(seq))
+    
+    def _set_array(self, a):
+        """Replaces the contents with the sorted, duplicate-free array a, which
+        must not be shared with anyone else"""
+        self._buf = a
+        self._len = len(a)
+    
+    def _array(self):
+        return self._buf[:self._len]
+    
+    def _to_array(self, seq):
+        """Returns the items of seq as a new sorted, duplicate-free array"""
+        if isinstance(seq, RecordSet) and (seq._dtype == self._dtype):
+            return seq._array().copy()
+        return _sort_unique(numpy.array(list(seq), dtype=self._dtype))
+    
+    def _set_list(self, L):
+        self._set_array(numpy.array(L, dtype=self._dtype))
+    
+    def _flat(self):
+        return self._array().tolist()
+    
+    def _range(self, start, stop):
+        return self._array()[start:stop].tolist()
+    
+    def _record(self, item):
+        """Returns item converted to the record layout"""
+        return numpy.array([item], dtype=self._dtype)[0].item()
+    
+    def _shift(self, start, stop, dest):
+        """Moves the records from start up to stop so that they begin at dest.
+        The bytes are moved rather than the records, which is much faster."""
+        raw = self._buf.view(numpy.uint8)
+        w = self._dtype.itemsize
+        raw[dest*w:(dest+stop-start)*w] = raw[start*w:stop*w]
+    
+    def _delete(self, i):
+        self._shift(i + 1, self._len, i)
+        self._len -= 1
+    
+    def _merge_array(self, b):
+        """Adds the items of the sorted, duplicate-free array b"""
+        a = self._array()
+        if len(b) * 32 < len(a):
+            for x in b.tolist():
+                self.add(x)
+        elif len(a) == 0:
+            self._set_array(numpy.array(b))
+        else:
+            (i, found) = _search(a, b)
+            new = ~found
+            if new.any():
+                self._set_array(numpy.insert(a, i[new], b[new]))
+    
+    def _subtract_array(self, b):
+        """Removes the items of the sorted, duplicate-free array b"""
+        a = self._array()
+        if len(b) * 32 < len(a):
+            for x in b.tolist():
+                self.discard(x)
+        else:
+            keep = ~_search(b, a)[1]
+            if not keep.all():
+                self._set_array(a[keep])
+    
+    def frombytes(self, data):
+        """Adds the records packed in data by a RecordPacker of the same format"""
+        self._merge_array(_sort_unique(numpy.frombuffer(data, dtype=self._dtype)))
+    
+    def tobytes(self):
+        """Returns the records packed as by a RecordPacker of the same format"""
+        return self._array().tobytes()
+    
+    def __contains__(self, item):
+        i = bisect.bisect_left(self, item)
+        return (i < self._len) and (self[i] == item)
+    
+    def __isub__(self, someset):
+        if isinstance(someset, RecordSet) and (someset._dtype == self._dtype):
+            self._subtract_array(someset._array())
+            return self
+        return ListSet.__isub__(self, someset)
+    
+    def __iter__(self):
+        a = self._array()
+        n = self.LOAD
+        return itertools.chain.from_iterable(a[i:i+n].tolist() for i in range(0, len(a), n))
+    
+    def __reversed__(self):
+        a = self._array()[::-1]
+        n = self.LOAD
+        return itertools.chain.from_iterable(a[i:i+n].tolist() for i in range(0, len(a), n))
+    
+    def __repr__(self):
+        return "RecordSet(" + repr(self.format) + ", " + repr(self._flat()) + ")"
+    
+    def add(self, item):
+        item = self._record(item)
+        n = self._len
+        if (n == 0) or (self[n - 1] < item):
+            i = n
+        else:
+            i = bisect.bisect_left(self, item)
+            if self[i] == item:
+                return
+        if n == len(self._buf):
+            buf = numpy.empty(n + n // 4 + 16, dtype=self._dtype)  # <= 25% slack
+            buf[:n] = self._buf[:n]
+            self._buf = buf
+        self._shift(i, n, i + 1)
+        self._buf[i] = item
+        self._len = n + 1
+    
+    def copy(self):
+        a = RecordSet(self.format)
+        a._set_array(self._array().copy())
+        return a
+    
+    def difference_update(self, iterable):
+        self._subtract_array(self._to_array(iterable))
+    
+    def discard(self, item):
+        i = bisect.bisect_left(self, item)
+        if (i < self._len) and (self[i] == item):
+            self._delete(i)
+    
+    def pop(self, i = None):
+        if i == None:
+            i = -1
+        i = self._normalize(i)
+        item = self[i]
+        self._delete(i)
+        return item
+    
+    def remove(self, item):
+        i = bisect.bisect_left(self, item)
+        if (i < self._len) and (self[i] == item):
+            self._delete(i)
+        else:
+            raise KeyError("Item is not in the set")
+    
+    def update(self, iterable):
+        self._merge_array(self._to_array(iterable))
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            a = self._array()[key]
+            if key.indices(self._len)[2] != 1:
+                a = numpy.sort(a)
+            s = RecordSet(self.format)
+            s._set_array(a.copy())
+            return s
+        else:
+            return self._buf[self._normalize(key)].item()
+    
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self._len)
+            if step != 1:
+                self._set_array(numpy.delete(self._array(), list(range(start, stop, step))))
+            elif start < stop:
+                n = self._len
+                self._shift(stop, n, start)
+                self._len = n - stop + start
+                if self._len * 2 < len(self._buf):
+                    self._buf = self._array().copy()
+        else:
+            self._delete(self._normalize(key))
+    
+    def index(self, x, i=0, j=None):
+        a = bisect.bisect_left(self, x)
+        if (a < self._len) and (self[a] == x) and (i <= a) and ((j is None) or (a < j)):
+            return a
+        raise ValueError("Item not found")
+    
+    def position(self, x, i=0, j=None):
+        a = bisect.bisect_left(self, x)
+        if j is not None:
+            a = min(a, j)
+        return max(a, i)
+    
+    def first(self):
+        return self[0]
+    
+    def last(self):
+        return self[-1]
+
+def sorted_set(seq=(), record_format=None):
+    """Returns a ListSet of the items in seq.  If record_format is given and
+    NumPy can represent it, the ListSet is a compact RecordSet."""
+    if (record_format is not None) and (_record_dtype(record_format) is not None):
+        return RecordSet(record_format, seq)
+    return ListSet(seq)
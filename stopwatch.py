@@ -14,17 +14,19 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import array
+import bisect
 import dbus
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
 from gi.repository import Pango
 import dobject
+import dobject_helpers
 import logging
-import time
-import _thread
 import threading
 import locale
+import math
 from gettext import gettext as _
 import powerd
 
@@ -41,6 +43,9 @@ class WatchModel():
 
     _default_basestate = (0.0, STATE_PAUSED)
 
+    # The folded state is cached once every FOLD_INTERVAL events
+    FOLD_INTERVAL = 16
+
     def _trans(self, s, pack):
         if pack:
             return dbus.Struct((dbus.Double(s[0]), dbus.Int32(s[1])),
@@ -48,22 +53,61 @@ class WatchModel():
         else:
             return (float(s[0]), int(s[1]))
 
-    def __init__(self, handler):
+    def _trans_ns(self, s, pack):
+        if pack:
+            return dbus.Struct((dobject.ns_translator(s[0], True),
+                                dbus.Int32(s[1])), signature="di")
+        else:
+            return (dobject.ns_translator(s[0], False), int(s[1]))
+
+    def __init__(self, handler, horizon=None, ns=False):
+        """If horizon is not None, events are compacted into the base state
+        once a RESET event is more than horizon seconds older than the newest
+        event in the history.  All peers must then run a version of this class
+        that honors the base state's time as a floor on the history.
+
+        If ns is True, the times in events and states are integer nanoseconds
+        instead of float seconds, which compare and deduplicate exactly.  Peers
+        that do not support packed messages still receive float seconds, which
+        convert back exactly."""
         self._logger = logging.getLogger('stopwatch.WatchModel')
+        if ns:
+            trans = self._trans_ns
+            score_trans = dobject.ns_translator
+            record_format = 'qi'
+            self._time = dobject_helpers.exact_ns
+            self._zero = 0
+            self._fold_typecode = 'q'
+            if horizon is not None:
+                horizon = dobject_helpers.seconds_to_ns(horizon)
+        else:
+            trans = self._trans
+            score_trans = dobject.float_translator
+            record_format = 'di'
+            self._time = float
+            self._zero = 0.0
+            self._fold_typecode = 'd'
         self._history = dobject.AddOnlySortedSet(handler,
-                                                 translator=self._trans)
+                                                 translator=trans,
+                                                 record_format=record_format)
         self._history_lock = threading.RLock()
+        self._horizon = horizon
 
         self._view_listener = None  # This must be done before _update_state
 
         handler2 = handler.copy("basestate")
 
         self._base_state = dobject.HighScore(handler2,
-                                             WatchModel._default_basestate,
-                                             float("-inf"), self._trans,
-                                             dobject.float_translator)
+                                             (self._zero,
+                                              WatchModel.STATE_PAUSED),
+                                             float("-inf"), trans,
+                                             score_trans)
 
         self._state = ()
+        self._fold_times = array.array(self._fold_typecode)
+        self._fold_states = array.array('b')
+        self._folded = 0  # the number of events covered by the fold cache
+        self._resets = []  # the RESET events in the history, in order
         self._update_state()  # sets the state to the base_state
 
         self._base_state.register_listener(self._basestate_cb)
@@ -72,30 +116,67 @@ class WatchModel():
     def get_state(self):
         return self._state
 
+    def state_at(self, t):
+        """Return the (timeval, state) pair that was in effect at group time t,
+        including any events at exactly t.  This is a bisection into the
+        history followed by a replay from the nearest cached state, so it costs
+        O(log n + FOLD_INTERVAL).  Times before the base
+        state (see horizon) report the base state.
+
+        t and timeval are integer nanoseconds if the model was created with
+        ns=True, and float seconds otherwise."""
+        self._history_lock.acquire()
+        q = self._fold_from(self._history.position((t, float("inf"))))
+        self._history_lock.release()
+        return q
+
+    def elapsed_at(self, t):
+        """Return the time shown by the watch at group time t.  Both are
+        integer nanoseconds if the model was created with ns=True, and float
+        seconds otherwise."""
+        q = self.state_at(t)
+        if q[1] == WatchModel.STATE_RUNNING:
+            return t - q[0]
+        else:
+            return q[0]
+
     def get_last_update_time(self):
         if len(self._history) > 0:
             lastevent = self._history.last()
             return lastevent[0]
         else:
-            return float("-inf")
+            return self._base_state.get_score()
 
     def reset(self, s, t):
         self._base_state.set_value(s, t)
-        self._update_state()
+        self._rebase()
 
     def _basestate_cb(self, v, s):
-        self._update_state()
+        self._rebase()
         self._trigger()
 
     def _history_cb(self, diffset):
-        self._update_state()
+        self._history_lock.acquire()
+        if len(diffset) > 0:
+            self._update_state(self._history.position(diffset.first()))
+            self._compact()
+        self._history_lock.release()
         self._trigger()
 
     def add_event_from_view(self, ev):
+        self.add_events((ev,))
+
+    def add_events(self, events):
+        """Add an iterable of (time, event type) pairs, such as events imported
+        from a log.  However many events there are, they are merged into the
+        history once, sent to the other peers in one message, refolded from
+        the earliest new event and reported to the view listener once."""
         self._history_lock.acquire()
-        if ev not in self._history:
-            self._history.add(ev)
-            self._update_state()
+        new = self._history.update((self._time(t), int(e))
+                                   for (t, e) in events)
+        if len(new) > 0:  # some were not duplicates or dropped by the floor
+            self._update_state(self._history.position(new.first()))
+            self._compact()
         self._history_lock.release()
         self._trigger()
 
@@ -105,31 +186,105 @@ class WatchModel():
         # UI reaching an inconsistent state, with the button toggled off
         # but the clock still running.
 
-    def _update_state(self):
-        self._logger.debug("_update_state")
-        init = self._base_state.get_value()
-        timeval = init[0]
-        s = init[1]
+    def _fold(self, q, ev):
+        """Apply the event ev to the folded state q, returning the new state"""
+        timeval = q[0]
+        s = q[1]
+        event_time = ev[0]
+        event_type = ev[1]
 
         # state machine
 
-        for ev in self._history:
-            event_time = ev[0]
-            event_type = ev[1]
-            if s == WatchModel.STATE_PAUSED:
-                if event_type == WatchModel.RUN_EVENT:
-                    s = WatchModel.STATE_RUNNING
-                    timeval = event_time - timeval
-                elif event_type == WatchModel.RESET_EVENT:
-                    timeval = 0.0
-            elif s == WatchModel.STATE_RUNNING:
-                if event_type == WatchModel.RESET_EVENT:
-                    timeval = event_time
-                elif event_type == WatchModel.PAUSE_EVENT:
-                    s = WatchModel.STATE_PAUSED
-                    timeval = event_time - timeval
-
-        return self._set_state((timeval, s))
+        if s == WatchModel.STATE_PAUSED:
+            if event_type == WatchModel.RUN_EVENT:
+                s = WatchModel.STATE_RUNNING
+                timeval = event_time - timeval
+            elif event_type == WatchModel.RESET_EVENT:
+                timeval = self._zero
+        elif s == WatchModel.STATE_RUNNING:
+            if event_type == WatchModel.RESET_EVENT:
+                timeval = event_time
+            elif event_type == WatchModel.PAUSE_EVENT:
+                s = WatchModel.STATE_PAUSED
+                timeval = event_time - timeval
+        return (timeval, s)
+
+    def _fold_from(self, i):
+        """Return the state reached after the first i events, replaying at
+        most FOLD_INTERVAL - 1 events from the nearest cached state"""
+        k = i // self.FOLD_INTERVAL
+        q = (self._fold_times[k], self._fold_states[k])
+        for j in range(k * self.FOLD_INTERVAL, i):
+            q = self._fold(q, self._history[j])
+        return q
+
+    def _update_state(self, start=0):
+        """Refold the history from the start'th event onward.
+
+        self._fold_times[k] and self._fold_states[k] cache the state reached
+        after the first k*FOLD_INTERVAL events, packed so that the cache costs
+        about one byte per event.  Only the events from the last cached state
+        before the insertion point of new events need to be replayed.  Calling
+        with start=0 replays the whole history, which is required whenever the
+        base state changes."""
+        self._logger.debug("_update_state")
+        self._history_lock.acquire()
+        if start == 0:
+            q = self._base_state.get_value()
+            self._fold_times = array.array(self._fold_typecode, [q[0]])
+            self._fold_states = array.array('b', [q[1]])
+            self._resets = []
+        else:
+            k = min(start, self._folded) // self.FOLD_INTERVAL
+            del self._fold_times[k + 1:]
+            del self._fold_states[k + 1:]
+            start = k * self.FOLD_INTERVAL
+            if start < len(self._history):
+                i = bisect.bisect_left(self._resets, self._history[start])
+                del self._resets[i:]
+
+        q = (self._fold_times[-1], self._fold_states[-1])
+        for i in range(start, len(self._history)):
+            ev = self._history[i]
+            q = self._fold(q, ev)
+            if (i + 1) % self.FOLD_INTERVAL == 0:
+                self._fold_times.append(q[0])
+                self._fold_states.append(q[1])
+            if ev[1] == WatchModel.RESET_EVENT:
+                self._resets.append(ev)
+        self._folded = len(self._history)
+        changed = self._set_state(q)
+        self._history_lock.release()
+
+        return changed
+
+    def _rebase(self):
+        """Forget the events that are already folded into the base state, and
+        replay the remaining history on top of it."""
+        self._history_lock.acquire()
+        (v, t) = self._base_state.get_pair()
+        self._history.set_floor((t, float("inf")))
+        self._update_state()
+        self._history_lock.release()
+
+    def _compact(self):
+        """Fold every event up to the last RESET that is more than
+        self._horizon older than the newest event into the base state.
+
+        The newest event stands in for the current group time, so no clock is
+        needed here.  Events that old have reached every connected peer, and
+        the new base state propagates like any other HighScore."""
+        if self._horizon is None or len(self._resets) == 0:
+            return
+        cutoff = self._history.last()[0] - self._horizon
+        i = bisect.bisect_left(self._resets, (cutoff,)) - 1
+        if i < 0:
+            return
+        ev = self._resets[i]
+        q = self._fold_from(self._history.position(ev) + 1)
+        self._logger.debug("_compact " + str(ev))
+        self._base_state.set_value((self._time(q[0]), q[1]), ev[0])
+        self._rebase()
 
     def is_running(self):
         return self._state[1] == WatchModel.STATE_RUNNING
@@ -149,33 +304,315 @@ class WatchModel():
 
     def _trigger(self):
         if self._view_listener is not None:
-            _thread.start_new_thread(self._view_listener, (self._state,))
+            self._view_listener(self._state)
+
+
+class Dispatcher():
+    """A Dispatcher delivers notifications from the models to the views on the
+    GLib main loop, so that views never need their own threads or locks.
+
+    Each notification is queued under a key, and only the newest notification
+    for each key is delivered.  A burst of network messages for one watch
+    therefore costs a single update.  All pending notifications are delivered
+    in one idle callback, in the order in which their keys were first queued,
+    so notifications for the same key are never reordered.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._scheduled = False
+
+    def dispatch(self, key, func, *args):
+        """Arrange for func(*args) to be called on the main loop, replacing any
+        call still pending under the same key"""
+        self._lock.acquire()
+        self._pending[key] = (func, args)
+        if not self._scheduled:
+            self._scheduled = True
+            GObject.idle_add(self._run)
+        self._lock.release()
+
+    def _run(self):
+        self._lock.acquire()
+        pending = self._pending
+        self._pending = {}
+        self._scheduled = False
+        self._lock.release()
+        for (func, args) in pending.values():
+            func(*args)
+        return False
+
+
+class Ticker():
+    """A Ticker redraws the time labels of all running watches from a single
+    GLib timeout, so that every label is updated in the same main loop pass.
+
+    Each view's tick(now) method redraws its label and returns the number of
+    seconds until the displayed digits next change.  The Ticker sleeps until
+    the earliest of those moments, but never for less than MIN_INTERVAL.  No
+    timeout exists while no watch is running or the activity is hidden.
+    """
+    MIN_INTERVAL = 0.07  # seconds
+
+    def __init__(self, clock):
+        """clock() returns the local time, like TimeHandler.local_time"""
+        self._clock = clock
+        self._due = {}  # view -> local time at which its label next changes
+        self._source = None
+        self._paused = False
+
+    def add(self, view):
+        """Start redrawing view, or redraw it now if it is already running"""
+        self._due[view] = float("-inf")
+        self._reschedule()
+
+    def remove(self, view):
+        if view in self._due:
+            del self._due[view]
+            self._reschedule()
+
+    def pause(self):
+        self._paused = True
+        self._unschedule()
+
+    def resume(self):
+        self._paused = False
+        for view in self._due:
+            self._due[view] = float("-inf")
+        self._reschedule()
+
+    def _reschedule(self):
+        self._unschedule()
+        self._tick()
+
+    def _unschedule(self):
+        if self._source is not None:
+            GObject.source_remove(self._source)
+            self._source = None
+
+    def _tick(self):
+        self._source = None
+        if self._paused or len(self._due) == 0:
+            return False
+        now = self._clock()
+        for (view, due) in list(self._due.items()):
+            if due <= now:
+                self._due[view] = now + view.tick(now)
+        delay = max(min(self._due.values()) - now, Ticker.MIN_INTERVAL)
+        self._source = GObject.timeout_add(int(math.ceil(delay * 1000)),
+                                           self._tick)
+        return False
+
+
+class TimeFormatter():
+    """A TimeFormatter turns times in seconds into strings at one of the
+    display precisions.  The locale's decimal point is looked up once, when
+    the formatter is created, and each string is then built from integer
+    hundredths, without going through the locale module.  Views share one
+    formatter per precision through get().
+    """
+    HUNDREDTHS = 0
+    TENTHS = 1
+    SECONDS = 2
+    MINUTES = 3
+
+    # The size of the last displayed digit of each precision, in hundredths
+    _digit_size = (1, 10, 100, 6000)
+
+    _shared = {}  # precision -> the formatter shared by every view
+
+    def __init__(self, precision):
+        conv = locale.localeconv()
+        self._precision = precision
+        self._size = TimeFormatter._digit_size[precision]
+        self._point = conv['decimal_point']
+        self._minutes = _('%s min')
+
+    @staticmethod
+    def get(precision):
+        """Return the shared TimeFormatter for precision, creating it on
+        first use"""
+        f = TimeFormatter._shared.get(precision)
+        if f is None:
+            f = TimeFormatter(precision)
+            TimeFormatter._shared[precision] = f
+        return f
+
+    def get_precision(self):
+        return self._precision
+
+    def _hundredths(self, t):
+        # The epsilon keeps values such as 0.29 from truncating to 0.28
+        return int(math.floor(max(0, t) * 100 + 1e-6))
+
+    def format(self, t):
+        """Return t, truncated to the precision, as a string"""
+        n = self._hundredths(t) // self._size
+        if self._precision == TimeFormatter.HUNDREDTHS:
+            return '%d%s%02d' % (n // 100, self._point, n % 100)
+        elif self._precision == TimeFormatter.TENTHS:
+            return '%d%s%d' % (n // 10, self._point, n % 10)
+        elif self._precision == TimeFormatter.SECONDS:
+            return str(n)
+        else:
+            return self._minutes % n
+
+    def next_change(self, t):
+        """Return the number of seconds after t at which format() changes"""
+        n = self._hundredths(t) // self._size
+        return (n + 1) * self._size / 100.0 - max(0, t)
+
+
+class Watch():
+    """A Watch holds the shared models of one stopwatch: its name, its
+    WatchModel and its marks.  Times and marks are integer nanoseconds in
+    the models, and are converted to float seconds only for display and for
+    the journal.  GUIView only creates a Watch when it is first
+    shown or has state to restore, and binds it to a OneWatchView only while
+    it is on screen.  Model notifications are forwarded through the
+    Dispatcher to whichever view is bound at the time.
+    """
+    HISTORY_HORIZON = 3600.0  # seconds of history kept behind a RESET
+    OUTBOX_DELAY = 0.2  # seconds that mark messages are coalesced
+
+    def __init__(self, number, tubebox, timer, dispatcher):
+        self._logger = logging.getLogger('stopwatch.Watch')
+        self.number = number
+        self._dispatcher = dispatcher
+        self._view = None
+
+        # Name edits are already debounced by OneWatchView.NAME_DELAY, so
+        # they are sent without an outbox.
+        name_handler = dobject.UnorderedHandler("name" + str(number), tubebox)
+        self.name_model = dobject.Latest(name_handler,
+                                         Watch.default_name(number),
+                                         time_handler=timer,
+                                         translator=dobject.string_translator)
+        watch_handler = dobject.UnorderedHandler("watch" + str(number),
+                                                 tubebox)
+        self.watch_model = WatchModel(watch_handler,
+                                      horizon=Watch.HISTORY_HORIZON, ns=True)
+        marks_handler = dobject.UnorderedHandler(
+            "marks" + str(number), tubebox, outbox_delay=Watch.OUTBOX_DELAY)
+        self.marks_model = dobject.AddOnlySet(
+            marks_handler, translator=dobject.ns_translator,
+            record_format='q')
+
+        self._marks_store = None  # created when the marks are first shown
+        self._marks_shown = dobject_helpers.ListSet()  # the rows, in order
+        self._new_marks = set()  # marks received but not yet displayed
+        self._marks_lock = threading.Lock()
+
+        self.name_model.register_listener(self._name_cb)
+        self.watch_model.register_view_listener(self._state_cb)
+        self.marks_model.register_listener(self._marks_cb)
+
+    @staticmethod
+    def default_name(number):
+        return _("Stopwatch") + " " + locale.str(number + 1)
+
+    def set_view(self, view):
+        self._view = view
+
+    def _name_cb(self, name):
+        self._dispatcher.dispatch((self.number, 'name'), self._show_name)
+
+    def _show_name(self):
+        if self._view is not None:
+            self._view.update_name(self.name_model.get_value())
+
+    def _state_cb(self, q):
+        self._dispatcher.dispatch((self.number, 'state'), self._show_state)
+
+    def _show_state(self):
+        if self._view is not None:
+            self._view.update_state(self.watch_model.get_state())
+
+    def _marks_cb(self, diffset):
+        self._marks_lock.acquire()
+        self._new_marks.update(diffset)
+        self._marks_lock.release()
+        self._dispatcher.dispatch((self.number, 'marks'), self._flush_marks)
+
+    def _flush_marks(self):
+        self._marks_lock.acquire()
+        marks = self._new_marks
+        self._new_marks = set()
+        self._marks_lock.release()
+        if self._view is not None:
+            self._view.add_marks(marks)
+        else:
+            self.add_marks(marks)
+
+    def get_marks_store(self):
+        """Return a Gtk.ListStore of all marks, in increasing order"""
+        if self._marks_store is None:
+            self._marks_shown = dobject_helpers.ListSet(self.marks_model)
+            self._fill_marks()
+        return self._marks_store
+
+    def _fill_marks(self):
+        # Filling a detached store avoids a row-inserted signal per mark
+        store = Gtk.ListStore(float)
+        for m in self._marks_shown:
+            store.append((dobject_helpers.ns_to_seconds(m),))
+        self._marks_store = store
+
+    def add_marks(self, marks):
+        """Insert marks into the marks store at their sorted positions.  A
+        mark later than all the others, such as a new lap, is appended, so
+        marking costs O(1) UI work however many marks there are."""
+        if self._marks_store is None:
+            return
+        new = [m for m in set(marks) if m not in self._marks_shown]
+        if len(new) == 0:
+            return
+        if len(new) > len(self._marks_shown):
+            self._marks_shown.update(new)
+            self._fill_marks()
+            return
+        new.sort()
+        for m in new:
+            i = self._marks_shown.position(m)
+            self._marks_shown.add(m)
+            row = (dobject_helpers.ns_to_seconds(m),)
+            if i == len(self._marks_shown) - 1:
+                self._marks_store.append(row)
+            else:
+                self._marks_store.insert(i, row)
 
 
 class OneWatchView():
-    def __init__(
-            self, mywatch, myname, mymarks, timer, activity, number, group):
+    MARKS_HEIGHT = 50  # pixels of marks list shown below each watch
+    NAME_DELAY = 0.75  # seconds of typing pause before a name is sent
+
+    def __init__(self, timer, group, ticker, select_cb):
+        """A OneWatchView is one on-screen row.  It shows whichever Watch is
+        bound to it, and calls select_cb(number) when its radio button is
+        chosen."""
         self._logger = logging.getLogger('stopwatch.OneWatchView')
-        self._watch_model = mywatch
-        self._name_model = myname
-        self._marks_model = mymarks
+        self._watch = None
         self._timer = timer
-        self._number = number
+        self._ticker = ticker
+        self._select_cb = select_cb
 
-        self._update_lock = threading.Lock()
         self._state = None
-        self._timeval = 0
-
-        self._offset = self._timer.get_offset()
+        self._timeval = 0  # seconds, for display
+        self._timeval_ns = 0
+        self._formatter = TimeFormatter.get(TimeFormatter.HUNDREDTHS)
+        self._time_text = None
 
         self._selected = Gtk.RadioButton()
         self._selected.join_group(group)
+        self._selected_handler = self._selected.connect('toggled',
+                                                        self._selected_cb)
 
         self._name = Gtk.Entry()
         self._name_changed_handler = self._name.connect('changed',
                                                         self._name_cb)
-        self._name_lock = threading.Lock()
-        self._name_model.register_listener(self._update_name_cb)
+        self._name.connect('focus-out-event', self._name_focus_out_cb)
+        self._name.connect('activate', self._name_activate_cb)
+        self._name_source = None  # pending name edit timeout
 
         check = Gtk.Image()
         check.set_from_file('check.svg')
@@ -183,7 +620,6 @@ class OneWatchView():
         self._run_button.set_image(check)
         self._run_button.props.focus_on_click = False
         self._run_handler = self._run_button.connect('clicked', self._run_cb)
-        self._run_button_lock = threading.Lock()
         self._run_button.set_tooltip_markup(_('<b>Start or stop</b>  Ctrl+S'))
 
         circle = Gtk.Image()
@@ -217,12 +653,6 @@ class OneWatchView():
         eb.add(self._time_label)
         eb.modify_bg(Gtk.StateType.NORMAL, Gdk.color_parse("white"))
 
-        self._should_update = threading.Event()
-        self._is_visible = threading.Event()
-        self._is_visible.set()
-        self._update_lock = threading.Lock()
-        self._label_lock = threading.Lock()
-
         self.box = Gtk.HBox()
         self.box.pack_start(self._name, True, True, 6)
         self.box.pack_start(self._run_button, False, True, 0)
@@ -234,20 +664,24 @@ class OneWatchView():
         markfont = Pango.FontDescription()
         markfont.set_family("monospace")
         markfont.set_size(Pango.SCALE * 10)
-        self._marks_label = Gtk.Label()
-        self._marks_label.modify_font(markfont)
-        self._marks_label.set_single_line_mode(True)
-        self._marks_label.set_selectable(True)
-        self._marks_label.set_alignment(0, 0.5)  # justify left
-        self._marks_label.set_padding(6, 0)
-        self._marks_model.register_listener(self._update_marks)
-        eb2 = Gtk.EventBox()
-        eb2.add(self._marks_label)
-        eb2.modify_bg(Gtk.StateType.NORMAL, Gdk.color_parse("white"))
+        renderer = Gtk.CellRendererText()
+        renderer.props.font_desc = markfont
+        renderer.props.xpad = 6
+        column = Gtk.TreeViewColumn()
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.pack_start(renderer, True)
+        column.set_cell_data_func(renderer, self._mark_data_func)
+        self._marks_store = None
+        self._marks_view = Gtk.TreeView()
+        self._marks_view.set_headers_visible(False)
+        self._marks_view.append_column(column)
+        self._marks_view.set_fixed_height_mode(True)
+        self._marks_view.props.can_focus = False
 
         self._sw = Gtk.ScrolledWindow()
-        self._sw.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.NEVER)
-        self._sw.add_with_viewport(eb2)
+        self._sw.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self._sw.set_min_content_height(OneWatchView.MARKS_HEIGHT)
+        self._sw.add(self._marks_view)
 
         filler0 = Gtk.VBox()
         filler0.pack_start(self.box, False, False, 0)
@@ -267,12 +701,19 @@ class OneWatchView():
         self.display.connect('focus-in-event', self._got_focus_cb)
         self.display.connect('focus-out-event', self._lost_focus_cb)
         self.display.add_events(Gdk.EventMask.ALL_EVENTS_MASK)
-        activity.connect('key-press-event', self._keypress_cb)
-        activity.connect('key-release-event', self._keyrelease_cb)
-
-        self._watch_model.register_view_listener(self.update_state)
 
-        _thread.start_new_thread(self._start_running, ())
+    def bind(self, watch):
+        """Show watch in this row, or nothing if watch is None"""
+        if watch is self._watch:
+            return
+        if self._watch is not None:
+            self.commit_name()
+            self._watch.set_view(None)
+            self._ticker.remove(self)
+        self._watch = watch
+        if watch is not None:
+            watch.set_view(self)
+            self.refresh()
 
     def _grab_focus(self):
         self._name.grab_focus()
@@ -280,88 +721,76 @@ class OneWatchView():
 
         return False
 
-    def get_selected(self):
-        return self._selected.get_active()
-
     def set_selected(self):
-        self._selected.set_active(True)
+        self.show_selected()
         if self._name.get_mapped():
             self._grab_focus()
         else:
             GObject.idle_add(self._grab_focus)
 
-    def get_number(self):
-        return self._number
+    def show_selected(self):
+        self._selected.handler_block(self._selected_handler)
+        self._selected.set_active(True)
+        self._selected.handler_unblock(self._selected_handler)
+
+    def _selected_cb(self, widget):
+        if widget.get_active() and self._watch is not None:
+            self._select_cb(self._watch.number)
+
+    def get_watch(self):
+        """Return the Watch shown in this row, or None"""
+        return self._watch
 
     def update_state(self, q):
         self._logger.debug("update_state: " + str(q))
-        self._update_lock.acquire()
-        self._logger.debug("acquired update_lock")
         self._state = q[1]
-        self._offset = self._timer.get_offset()
+        self._timeval_ns = q[0]
+        self._timeval = dobject_helpers.ns_to_seconds(q[0])
         if self._state == WatchModel.STATE_RUNNING:
-            self._timeval = q[0]
             self._set_run_button_active(True)
-            self._should_update.set()
+            self._ticker.add(self)
         else:
             self._set_run_button_active(False)
-            self._should_update.clear()
-            self._label_lock.acquire()
-            self._timeval = q[0]
-            ev = threading.Event()
-            GObject.idle_add(self._update_label, self._format(self._timeval),
-                             ev)
-            ev.wait()
-            self._label_lock.release()
-        self._update_lock.release()
-
-    def _update_name_cb(self, name):
-        self._logger.debug("_update_name_cb " + name)
-        _thread.start_new_thread(self.update_name, (name,))
+            self._ticker.remove(self)
+            self._set_time_text(self._format(self._timeval))
 
     def update_name(self, name):
         self._logger.debug("update_name " + name)
-        self._name_lock.acquire()
-        self._name.set_editable(False)
+        if self._name_source is not None:
+            return  # the local edit is newer, and will be sent shortly
         self._name.handler_block(self._name_changed_handler)
-        ev = threading.Event()
-        GObject.idle_add(self._set_name, name, ev)
-        ev.wait()
-        self._name.handler_unblock(self._name_changed_handler)
-        self._name.set_editable(True)
-        self._name_lock.release()
-
-    def _set_name(self, name, ev):
         self._name.set_text(name)
-        ev.set()
-        return False
+        self._name.handler_unblock(self._name_changed_handler)
 
     def _format(self, t):
-        return locale.format('%.2f', max(0, t))
+        return self._formatter.format(t)
 
-    def _update_label(self, string, ev):
-        self._time_label.set_text(string)
-        ev.set()
-        return False
+    def _set_time_text(self, text):
+        if text != self._time_text:
+            self._time_text = text
+            self._time_label.set_text(text)
 
-    def _start_running(self):
-        self._logger.debug("_start_running")
-        ev = threading.Event()
-        while True:
-            self._should_update.wait()
-            self._is_visible.wait()
-            self._label_lock.acquire()
-            if self._should_update.isSet() and self._is_visible.isSet():
-                s = self._format(time.time() +
-                                 self._timer.offset - self._timeval)
-                ev.clear()
-                GObject.idle_add(self._update_label, s, ev)
-                ev.wait()
-                time.sleep(0.07)
-            self._label_lock.release()
+    def get_precision(self):
+        return self._formatter.get_precision()
+
+    def set_precision(self, precision):
+        self._formatter = TimeFormatter.get(precision)
+        if self._state == WatchModel.STATE_RUNNING:
+            self._ticker.add(self)
+        else:
+            self._set_time_text(self._format(self._timeval))
+        self._show_marks()
+
+    def tick(self, now):
+        """Redraw the running time as of local time now, and return the
+        number of seconds until the displayed digits change.  Called by the
+        Ticker."""
+        t = now + self._timer.get_offset() - self._timeval
+        self._set_time_text(self._format(t))
+        return self._formatter.next_change(t)
 
     def _run_cb(self, widget):
-        t = time.time()
+        t = self._timer.time_ns()
         self._logger.debug("run button pressed: " + str(t))
         if self._run_button.get_active():  # button has _just_ been set active
             action = WatchModel.RUN_EVENT
@@ -369,80 +798,111 @@ class OneWatchView():
         else:
             action = WatchModel.PAUSE_EVENT
             suspend.uninhibit()
-        self._watch_model.add_event_from_view((self._timer.get_offset() + t,
-                                              action))
+        self._watch.watch_model.add_event_from_view((t, action))
         return True
 
     def _set_run_button_active(self, v):
-        self._run_button_lock.acquire()
         self._run_button.handler_block(self._run_handler)
         self._run_button.set_active(v)
         self._run_button.handler_unblock(self._run_handler)
-        self._run_button_lock.release()
 
     def _reset_cb(self, widget):
-        t = time.time()
-        self._watch_model.add_event_from_view((self._timer.get_offset() + t,
-                                              WatchModel.RESET_EVENT))
+        self._watch.watch_model.add_event_from_view(
+            (self._timer.time_ns(), WatchModel.RESET_EVENT))
         return True
 
-    def _reset_press(self):
+    def run_press(self):
+        self._run_button.clicked()
+
+    def reset_press(self):
         self._reset_cb(self._reset_button)
         self._reset_button.set_state(Gtk.StateType.ACTIVE)
 
-    def _reset_release(self):
+    def reset_release(self):
         self._reset_button.set_state(Gtk.StateType.NORMAL)
 
     def _mark_cb(self, widget):
-        t = time.time() + self._offset
+        t = self._timer.time_ns()
         self._logger.debug("mark button pressed: " + str(t))
         s = self._state
-        tval = self._timeval
+        tval = self._timeval_ns
         if s == WatchModel.STATE_RUNNING:
-            self._marks_model.add(max(0.0, t - tval))
+            mark = dobject_helpers.exact_ns(max(0, t - tval))
         elif s == WatchModel.STATE_PAUSED:
-            self._marks_model.add(tval)
-        self._update_marks()
+            mark = tval
+        else:
+            return
+        self._watch.marks_model.add(mark)
+        self.add_marks((mark,))
 
-    def _mark_press(self):
+    def mark_press(self):
         self._mark_button.clicked()
         self._mark_button.set_state(Gtk.StateType.ACTIVE)
 
-    def _mark_release(self):
+    def mark_release(self):
         self._mark_button.set_state(Gtk.StateType.NORMAL)
 
     def _update_sw(self):
-        a = self._sw.get_hadjustment()
-        a.set_value(a.get_upper())
+        a = self._sw.get_vadjustment()
+        a.set_value(a.get_upper() - a.get_page_size())
         return False
 
-    def _update_marks(self, diffset=None):
-        L = list(self._marks_model)
-        L.sort()
-        s = [self._format(num) for num in L[-16:]]
-        p = " ".join(s)
-        self._marks_label.set_text(p)
-        if hasattr(self, '_sw'):
+    def _mark_data_func(self, column, renderer, model, it, data=None):
+        # Rows are only formatted when GTK draws them, so only the visible
+        # marks are ever formatted.
+        renderer.props.text = self._format(model.get_value(it, 0))
+
+    def add_marks(self, marks):
+        """Add marks to the bound Watch's marks, following the newest mark
+        unless the user has scrolled away from it"""
+        a = self._sw.get_vadjustment()
+        at_end = a.get_value() >= a.get_upper() - a.get_page_size()
+        self._watch.add_marks(marks)
+        self._set_marks_store(self._watch.get_marks_store())
+        if at_end:
             GObject.idle_add(self._update_sw)
 
+    def _set_marks_store(self, store):
+        if store is not self._marks_store:
+            self._marks_store = store
+            self._marks_view.set_model(store)
+
+    def _show_marks(self):
+        self._marks_view.queue_draw()
+
     def _name_cb(self, widget):
-        self._name_model.set_value(widget.get_text())
+        # Each keystroke restarts the timeout, so the name is only sent once
+        # typing pauses.
+        if self._name_source is not None:
+            GObject.source_remove(self._name_source)
+        self._name_source = GObject.timeout_add(
+            int(OneWatchView.NAME_DELAY * 1000), self._name_timeout)
         return True
 
-    def pause(self):
-        self._logger.debug("pause")
-        self._is_visible.clear()
+    def _name_timeout(self):
+        self._name_source = None
+        self._watch.name_model.set_value(self._name.get_text())
+        return False
 
-    def resume(self):
-        self._logger.debug("resume")
-        self._is_visible.set()
+    def commit_name(self):
+        """Send any pending name edit now"""
+        if self._name_source is not None:
+            GObject.source_remove(self._name_source)
+            self._name_timeout()
+
+    def _name_focus_out_cb(self, widget, event):
+        self.commit_name()
+        return False
+
+    def _name_activate_cb(self, widget):
+        self.commit_name()
 
     def refresh(self):
         """Make sure display is up-to-date"""
-        self._update_name_cb(self._name_model.get_value())
-        _thread.start_new_thread(self.update_state,
-                                (self._watch_model.get_state(),))
-        self._update_marks()
+        self.update_name(self._watch.name_model.get_value())
+        self.update_state(self._watch.watch_model.get_state())
+        self._set_marks_store(self._watch.get_marks_store())
+        GObject.idle_add(self._update_sw)
 
     def _got_focus_cb(self, widget, event):
         self._logger.debug("got focus")
@@ -456,136 +916,271 @@ class OneWatchView():
         self._name.modify_bg(Gtk.StateType.NORMAL, self._gray)
         return True
 
-    def _key_dispatch(self, norm, ctrl, event):
-        if event.get_state() & Gdk.ModifierType.CONTROL_MASK:
-            if event.keyval in ctrl:
-                ctrl[event.keyval]()
-                return True
-
-        if event.keyval in norm:
-            norm[event.keyval]()
-            return True
-
-        return False
-
-    def _keypress_cb(self, widget, event):
 
-        if not self.get_selected():
-            return False
+class GUIView():
+    NUM_WATCHES = 9  # default number of watches
+    MAX_WATCHES = 999
+    ROWS = 9  # number of watches on screen at once
 
-        norm = {
-            Gdk.KEY_KP_End: self._run_button.clicked,  # check gamekey
-            Gdk.KEY_KP_Page_Up: self._reset_press,  # O gamekey
-            Gdk.KEY_KP_Page_Down: self._mark_press,  # X gamekey
+    def __init__(self, tubebox, timer, activity, num_watches=NUM_WATCHES):
+        self.timer = timer
+        self._tubebox = tubebox
+        self._watches = {}  # number -> Watch, created on demand
+        self._num_watches = num_watches
+        self._first = 0  # number of the watch in the top row
+        self._selected = 0
+        self._precision = TimeFormatter.HUNDREDTHS
+        self._dispatcher = Dispatcher()
+        self._ticker = Ticker(timer.local_time)
+
+        # Keymaps from keyval to the OneWatchView method that handles it on
+        # the selected watch.
+        self._press_keys = {
+            Gdk.KEY_KP_End: OneWatchView.run_press,  # check gamekey
+            Gdk.KEY_KP_Page_Up: OneWatchView.reset_press,  # O gamekey
+            Gdk.KEY_KP_Page_Down: OneWatchView.mark_press,  # X gamekey
         }
-
-        ctrl = {
-            Gdk.KEY_s: self._run_button.clicked,
-            Gdk.KEY_z: self._reset_press,
-            Gdk.KEY_m: self._mark_press,
+        self._ctrl_press_keys = {
+            Gdk.KEY_s: OneWatchView.run_press,
+            Gdk.KEY_z: OneWatchView.reset_press,
+            Gdk.KEY_m: OneWatchView.mark_press,
             # TODO: ctrl+c copy name = value
             # TODO: ctrl+v paste name = value
         }
+        self._release_keys = {
+            Gdk.KEY_KP_Page_Up: OneWatchView.reset_release,  # O gamekey
+            Gdk.KEY_KP_Page_Down: OneWatchView.mark_release,  # X gamekey
+        }
+        self._ctrl_release_keys = {
+            Gdk.KEY_z: OneWatchView.reset_release,
+            Gdk.KEY_m: OneWatchView.mark_release,
+        }
+        self._move_keys = {
+            Gdk.KEY_Up: self.select_up,
+            Gdk.KEY_ISO_Left_Tab: self.select_up,
+            Gdk.KEY_Down: self.select_down,
+            Gdk.KEY_Tab: self.select_down,
+        }
+        activity.connect('key-press-event', self._keypress_cb)
+        activity.connect('key-release-event', self._keyrelease_cb)
 
-        return self._key_dispatch(norm, ctrl, event)
-
-    def _keyrelease_cb(self, widget, event):
-        self._logger.debug("key press: " + Gdk.keyval_name(event.keyval) +
-                           " " + str(event.keyval))
+        # The group leader is never shown.  It is active whenever the
+        # selected watch is scrolled off screen.
+        self._bogus = Gtk.RadioButton()
+        self._views = [OneWatchView(timer, self._bogus,
+                                    self._ticker, self._select_cb)
+                       for i in range(GUIView.ROWS)]
+
+        self._adjustment = Gtk.Adjustment(value=0, lower=0,
+                                          upper=num_watches,
+                                          step_increment=1,
+                                          page_increment=GUIView.ROWS,
+                                          page_size=GUIView.ROWS)
+        self._adjustment.connect('value-changed', self._scrolled_cb)
+        self._scrollbar = Gtk.VScrollbar(adjustment=self._adjustment)
+
+        rows = Gtk.VBox()
+        for x in self._views:
+            rows.pack_start(x.display, True, True, 0)
+            x.display.show_all()
+            x.display.set_no_show_all(True)
+        self._scrollbar.set_no_show_all(True)
 
-        if not self.get_selected():
-            return False
+        events = Gtk.EventBox()
+        events.add(rows)
+        events.connect('scroll-event', self._scroll_event_cb)
 
-        norm = {
-            Gdk.KEY_KP_Page_Up: self._reset_release,  # O gamekey
-            Gdk.KEY_KP_Page_Down: self._mark_release,  # X gamekey
-        }
+        self.display = Gtk.HBox()
+        self.display.pack_start(events, True, True, 0)
+        self.display.pack_start(self._scrollbar, False, False, 0)
 
-        ctrl = {
-            Gdk.KEY_z: self._reset_release,
-            Gdk.KEY_m: self._mark_release,
-        }
+        self._rebind()
+        self.set_selected(0)
 
-        return self._key_dispatch(norm, ctrl, event)
+    def _get_watch(self, i):
+        watch = self._watches.get(i)
+        if watch is None:
+            watch = Watch(i, self._tubebox, self.timer, self._dispatcher)
+            self._watches[i] = watch
+        return watch
+
+    def _rebind(self):
+        for (k, view) in enumerate(self._views):
+            i = self._first + k
+            if i < self._num_watches:
+                view.bind(self._get_watch(i))
+                view.display.show()
+            else:
+                view.bind(None)
+                view.display.hide()
+        self._scrollbar.set_visible(self._num_watches > GUIView.ROWS)
+        self._show_selected()
+
+    def _scroll_to(self, first):
+        if first != self._first:
+            self._first = first
+            self._rebind()
+        self._adjustment.set_value(first)
+
+    def _scrolled_cb(self, adjustment):
+        self._scroll_to(int(round(adjustment.get_value())))
+
+    def _scroll_event_cb(self, widget, event):
+        if event.direction == Gdk.ScrollDirection.UP:
+            step = -1
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            step = 1
+        else:
+            return False
+        a = self._adjustment
+        a.set_value(min(max(a.get_value() + step, a.get_lower()),
+                        a.get_upper() - a.get_page_size()))
+        return True
 
+    def _get_view(self, i):
+        """Return the view showing watch i, or None if it is off screen"""
+        k = i - self._first
+        if (0 <= k < len(self._views)) and (i < self._num_watches):
+            return self._views[k]
+        return None
+
+    def _reveal(self, i):
+        """Scroll watch i into view if necessary, and return its view"""
+        if i < self._first:
+            self._scroll_to(i)
+        elif i >= self._first + GUIView.ROWS:
+            self._scroll_to(i - GUIView.ROWS + 1)
+        return self._get_view(i)
 
-class GUIView():
-    NUM_WATCHES = 9
+    def _key_dispatch(self, norm, ctrl, event):
+        f = None
+        if event.get_state() & Gdk.ModifierType.CONTROL_MASK:
+            f = ctrl.get(event.keyval)
+        if f is None:
+            f = norm.get(event.keyval)
+        if f is None:
+            return False
 
-    def __init__(self, tubebox, timer, activity):
-        self.timer = timer
-        self._views = []
-        self._names = []
-        self._watches = []
-        self._markers = []
-        bogus = Gtk.RadioButton()
-        for i in range(GUIView.NUM_WATCHES):
-            name_handler = dobject.UnorderedHandler("name" + str(i), tubebox)
-            name_model = dobject.Latest(name_handler,
-                                        _("Stopwatch") + " " +
-                                        locale.str(i + 1),
-                                        time_handler=timer,
-                                        translator=dobject.string_translator)
-            self._names.append(name_model)
-            watch_handler = dobject.UnorderedHandler("watch" + str(i), tubebox)
-            watch_model = WatchModel(watch_handler)
-            self._watches.append(watch_model)
-            marks_handler = dobject.UnorderedHandler("marks" + str(i), tubebox)
-            marks_model = dobject.AddOnlySet(
-                marks_handler, translator=dobject.float_translator)
-            self._markers.append(marks_model)
-            watch_view = OneWatchView(watch_model, name_model, marks_model,
-                                      timer, activity, i, bogus)
-            self._views.append(watch_view)
-        del bogus
-        self.set_selected(0)
+        # The selected watch may have been scrolled off screen
+        f(self._reveal(self._selected))
+        return True
 
-        self.display = Gtk.VBox()
-        for x in self._views:
-            self.display.pack_start(x.display, True, True, 0)
+    def _keypress_cb(self, widget, event):
+        f = self._move_keys.get(event.keyval)
+        if f is not None:
+            f()
+            return True
+        return self._key_dispatch(self._press_keys, self._ctrl_press_keys,
+                                  event)
 
-        self._pause_lock = threading.Lock()
+    def _keyrelease_cb(self, widget, event):
+        return self._key_dispatch(self._release_keys, self._ctrl_release_keys,
+                                  event)
+
+    def get_num_watches(self):
+        return self._num_watches
+
+    def set_num_watches(self, n):
+        n = max(1, min(n, GUIView.MAX_WATCHES))
+        if n == self._num_watches:
+            return
+        self._num_watches = n
+        self._adjustment.set_upper(n)
+        if self._selected >= n:
+            self._selected = n - 1
+        self._rebind()
+        self._scroll_to(max(0, min(self._first, n - GUIView.ROWS)))
 
     def get_names(self):
-        return [n.get_value() for n in self._names]
+        names = []
+        for i in range(self._num_watches):
+            if i in self._watches:
+                names.append(self._watches[i].name_model.get_value())
+            else:
+                names.append(Watch.default_name(i))
+        return names
 
     def set_names(self, namestate):
-        for i in range(GUIView.NUM_WATCHES):
-            self._names[i].set_value(namestate[i])
+        for (i, name) in enumerate(namestate):
+            if (i in self._watches) or (name != Watch.default_name(i)):
+                self._get_watch(i).name_model.set_value(name)
 
     def get_state(self):
-        return [(w.get_state(),
-                w.get_last_update_time()) for w in self._watches]
+        states = []
+        for i in range(self._num_watches):
+            if i in self._watches:
+                w = self._watches[i].watch_model
+                (timeval, state) = w.get_state()
+                t = w.get_last_update_time()
+                states.append(((dobject_helpers.ns_to_seconds(timeval), state),
+                               dobject_helpers.ns_to_seconds(t)))
+            else:
+                states.append((WatchModel._default_basestate,
+                               float("-inf")))
+        return states
 
     def set_state(self, states):
-        for i in range(GUIView.NUM_WATCHES):
-            self._watches[i].reset(states[i][0], states[i][1])
-            if self._watches[i].is_running():
-                suspend.inhibit()
+        for (i, (state, t)) in enumerate(states):
+            state = tuple(state)
+            if (i in self._watches) or \
+                    (state != WatchModel._default_basestate):
+                w = self._get_watch(i).watch_model
+                w.reset((dobject_helpers.seconds_to_ns(state[0]), state[1]),
+                        dobject_helpers.seconds_to_ns(t))
+                if w.is_running():
+                    suspend.inhibit()
 
     def get_marks(self):
-        return [list(m) for m in self._markers]
+        marks = []
+        for i in range(self._num_watches):
+            if i in self._watches:
+                marks.append([dobject_helpers.ns_to_seconds(m)
+                              for m in self._watches[i].marks_model])
+            else:
+                marks.append([])
+        return marks
 
     def set_marks(self, marks):
-        for i in range(GUIView.NUM_WATCHES):
-            self._markers[i].update(marks[i])
+        for (i, m) in enumerate(marks):
+            if (i in self._watches) or (len(m) > 0):
+                self._get_watch(i).marks_model.update(
+                    dobject_helpers.seconds_to_ns(x) for x in m)
+
+    def _select_cb(self, selected):
+        self._selected = selected
+
+    def _show_selected(self):
+        view = self._get_view(self._selected)
+        if view is None:
+            self._bogus.set_active(True)
+        else:
+            view.show_selected()
 
     def get_selected(self):
-        selected = 0
-        for view in self._views:
-            if view.get_selected():
-                selected = view.get_number()
-        return selected
+        return self._selected
 
     def set_selected(self, selected):
-        self._views[selected].set_selected()
+        self._selected = selected
+        self._reveal(selected).set_selected()
+
+    def get_precision(self):
+        return self._precision
+
+    def set_precision(self, precision):
+        self._precision = precision
+        for v in self._views:
+            v.set_precision(precision)
 
     def get_all(self):
+        for v in self._views:
+            v.commit_name()
         return (self.timer.get_offset(), self.get_names(),
-                self.get_state(), self.get_marks(), self.get_selected())
+                self.get_state(), self.get_marks(), self.get_selected(),
+                self.get_precision())
 
     def set_all(self, q):
         self.timer.set_offset(q[0])
+        self.set_num_watches(len(q[1]))
         self.set_names(q[1])
         self.set_state(q[2])
         self.set_marks(q[3])
@@ -593,25 +1188,25 @@ class GUIView():
             selected = int(q[4])
         except IndexError:
             selected = 0
+        try:
+            precision = int(q[5])
+        except IndexError:
+            precision = TimeFormatter.HUNDREDTHS
+        self.set_precision(precision)
         for v in self._views:
-            v.refresh()
-        self.set_selected(selected)
+            if v.get_watch() is not None:
+                v.refresh()
+        self.set_selected(min(selected, self._num_watches - 1))
 
     def pause(self):
-        self._pause_lock.acquire()
-        for w in self._views:
-            w.pause()
-        self._pause_lock.release()
+        self._ticker.pause()
 
     def resume(self):
-        self._pause_lock.acquire()
-        for w in self._views:
-            w.resume()
-        self._pause_lock.release()
+        self._ticker.resume()
 
     def select_down(self):
         selected = self.get_selected() + 1
-        if selected < GUIView.NUM_WATCHES:
+        if selected < self._num_watches:
             self.set_selected(selected)
 
     def select_up(self):
@@ -0,0 +1,170 @@
+import bisect
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dobject_helpers
+
+
+class SmallListSet(dobject_helpers.ListSet):
+    LOAD = 4
+
+
+class SmallRecordSet(dobject_helpers.RecordSet):
+    LOAD = 4
+
+
+class SortedSetChecks:
+    """Checks of a sorted set against a sorted list of the same items.  The
+    sets use a small LOAD, so that every operation crosses chunk boundaries."""
+
+    def make(self, seq=()):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def random_items(self, n):
+        return [(self.rng.randrange(200), self.rng.randrange(3))
+                for _ in range(n)]
+
+    def check(self, s, ref):
+        self.assertEqual(len(s), len(ref))
+        self.assertEqual(list(s), ref)
+        self.assertEqual(list(reversed(s)), ref[::-1])
+
+    def test_add_discard(self):
+        s = self.make()
+        ref = set()
+        for _ in range(2000):
+            item = self.random_items(1)[0]
+            if self.rng.random() < 0.6:
+                s.add(item)
+                ref.add(item)
+            else:
+                s.discard(item)
+                ref.discard(item)
+            self.assertEqual(item in s, item in ref)
+        self.check(s, sorted(ref))
+        if hasattr(s, '_lists'):
+            self.assertGreater(len(s._lists), 2)
+
+    def test_position(self):
+        ref = sorted(set(self.random_items(300)))
+        s = self.make(ref)
+        for x in range(-1, 202):
+            for y in (-1, 1, 3):
+                a = bisect.bisect_left(ref, (x, y))
+                self.assertEqual(s.position((x, y)), a)
+                self.assertEqual(s.position((x, y), 10, 50),
+                                 min(max(a, 10), 50))
+
+    def test_index(self):
+        ref = sorted(set(self.random_items(300)))
+        s = self.make(ref)
+        for (a, item) in enumerate(ref):
+            self.assertEqual(s.index(item), a)
+        self.assertRaises(ValueError, s.index, (-1, 0))
+        self.assertRaises(ValueError, s.index, ref[5], 6)
+        self.assertRaises(ValueError, s.index, ref[5], 0, 5)
+        self.assertEqual(s.index(ref[5], 5, 6), 5)
+
+    def test_getitem(self):
+        ref = sorted(set(self.random_items(300)))
+        s = self.make(ref)
+        for i in list(range(len(ref))) + [-1, -7, -len(ref)]:
+            self.assertEqual(s[i], ref[i])
+        self.assertRaises(IndexError, s.__getitem__, len(ref))
+        self.assertRaises(IndexError, s.__getitem__, -len(ref) - 1)
+        for key in (slice(3, 17), slice(5, 200), slice(-30, None),
+                    slice(None, 9), slice(50, 10), slice(1, 100, 7),
+                    slice(None, None, -3)):
+            self.assertEqual(list(s[key]), sorted(ref[key]))
+
+    def test_delitem(self):
+        ref = sorted(set(self.random_items(500)))
+        s = self.make(ref)
+        for _ in range(60):
+            n = len(ref)
+            if n == 0:
+                break
+            start = self.rng.randrange(n)
+            stop = min(n, start + self.rng.randrange(1, 40))
+            key = self.rng.choice([start, slice(start, stop),
+                                   slice(start, stop, 3), slice(stop, start)])
+            del s[key]
+            del ref[key]
+            self.check(s, ref)
+            # The index must still agree after the deletion
+            for item in ref[::7]:
+                self.assertEqual(s.index(item), ref.index(item))
+            item = self.random_items(1)[0]
+            s.add(item)
+            if item not in ref:
+                bisect.insort(ref, item)
+            self.assertEqual(s.position(item), ref.index(item))
+        del s[:]
+        self.check(s, [])
+
+    def test_copy_then_mutate(self):
+        a = self.make([(5, 1), (1, 1), (9, 1)])
+        c = a.copy()
+        c.discard((1, 1))
+        c.add((7, 2))
+        self.assertEqual(list(a), [(1, 1), (5, 1), (9, 1)])
+        self.assertEqual(list(c), [(5, 1), (7, 2), (9, 1)])
+
+
+class ListSetTest(SortedSetChecks, unittest.TestCase):
+
+    def make(self, seq=()):
+        return SmallListSet(seq)
+
+
+@unittest.skipIf(dobject_helpers.numpy is None, 'RecordSet requires NumPy')
+class RecordSetTest(SortedSetChecks, unittest.TestCase):
+
+    def make(self, seq=()):
+        return SmallRecordSet('qi', seq)
+
+    def setUp(self):
+        SortedSetChecks.setUp(self)
+        self.a = dobject_helpers.sorted_set([(5, 1), (1, 1), (9, 1)], 'qi')
+
+    def test_is_record_set(self):
+        self.assertIsInstance(self.a, dobject_helpers.RecordSet)
+
+    def test_construct_from_record_set_then_mutate(self):
+        # A set built from another RecordSet must not share its buffer
+        c = dobject_helpers.sorted_set(self.a, 'qi')
+        c.discard((1, 1))
+        c.add((7, 2))
+        del c[:1]
+        self.assertEqual(list(self.a), [(1, 1), (5, 1), (9, 1)])
+        self.assertEqual(list(c), [(7, 2), (9, 1)])
+
+    def test_update_from_record_set_then_mutate(self):
+        c = dobject_helpers.RecordSet('qi')
+        c.update(self.a)
+        c.discard((5, 1))
+        self.assertEqual(list(self.a), [(1, 1), (5, 1), (9, 1)])
+        self.assertEqual(list(c), [(1, 1), (9, 1)])
+
+    def test_copy_then_pop(self):
+        c = self.a.copy()
+        c.pop()
+        self.assertEqual(list(self.a), [(1, 1), (5, 1), (9, 1)])
+
+    def test_bytes_round_trip(self):
+        packer = dobject_helpers.RecordPacker('qi')
+        c = dobject_helpers.RecordSet('qi')
+        c.frombytes(packer.pack([(9, 1), (3, 2), (9, 1)]))
+        self.assertEqual(list(c), [(3, 2), (9, 1)])
+        self.assertEqual(packer.unpack(c.tobytes()), [(3, 2), (9, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()